@@ -0,0 +1,277 @@
+"""
+Per-server admission queue and retry policy
+
+MetroPro executes one remote command at a time. Rather than letting every
+thread race for the server and fail with MRC_ERR_SERVER_BUSY, commands for a
+given server are admitted one at a time:
+
+    * within a process, waiting commands are ordered by (priority, arrival)
+    * across processes, admission is serialized by a lock file per server
+    * retryable error codes (see RETRYABLE_ERRORS) are retried with jittered
+      exponential backoff while the command keeps its place at the head of
+      the queue; all other errors are raised immediately
+"""
+
+from __future__ import print_function
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import mrc_common
+
+try:
+    import msvcrt
+except ImportError:
+    # resolved once: a failed import is far slower than the lock itself
+    msvcrt = None
+    import fcntl
+
+RETRYABLE_ERRORS = frozenset([
+    mrc_common.MRC_ERR_SERVER_BUSY,
+    mrc_common.MRC_ERR_COMMAND_TIMEOUT,
+    mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY,
+])
+
+
+class RetryPolicy(object):
+    '''
+    Jittered exponential backoff for retryable MRC error codes
+
+    max_attempts: total attempts, including the first (None: unlimited)
+    base_delay, max_delay: backoff bounds, in seconds
+    '''
+    def __init__(self, max_attempts=20, base_delay=0.01, max_delay=1.0,
+                 retryable=RETRYABLE_ERRORS):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = frozenset(retryable)
+
+    def is_retryable(self, ex):
+        return getattr(ex, 'code', None) in self.retryable
+
+    def delay(self, attempt):
+        '''Backoff before retry number `attempt` (1-based), "full jitter"'''
+        import random
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+
+class _InterProcessLock(object):
+    '''Exclusive lock on a file, shared by all processes using a server'''
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _open(self):
+        # the file stays open between commands, saving an open/close per
+        # command; a forked child must not share our open file (and with it
+        # the flock), so it opens its own
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self._pid = os.getpid()
+        return self._fd
+
+    def acquire(self):
+        fd = self._open()
+        if msvcrt is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    break
+                except (IOError, OSError):
+                    time.sleep(0.001)
+
+    def release(self):
+        if msvcrt is None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+
+class AdmissionQueue(object):
+    '''
+    Serializes commands to a single server
+
+    Use get_queue() to obtain the shared queue for a server rather than
+    creating one directly.
+    '''
+    def __init__(self, key, policy=None, interprocess=True):
+        self.key = key
+        self.policy = policy if policy is not None else RetryPolicy()
+        self._cond = threading.Condition(threading.Lock())
+        self._waiting = []
+        self._counter = itertools.count()
+        self._busy = False
+        self._local = threading.local()
+
+        if interprocess:
+            import hashlib
+            import tempfile
+            digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+            fn = os.path.join(tempfile.gettempdir(), 'pyzygo-%s.lock' % digest)
+            self._ipc_lock = _InterProcessLock(fn)
+        else:
+            self._ipc_lock = None
+
+        self.submitted = 0
+        self.retries = 0
+        self.total_wait = 0.0
+
+    @property
+    def last_wait(self):
+        '''Time the calling thread's last command spent queued'''
+        return getattr(self._local, 'wait', 0.0)
+
+    def run(self, fcn, args=(), priority=0, policy=None):
+        '''
+        Run fcn(*args) once admitted, retrying retryable MRC errors
+
+        Lower priority values are admitted first; equal priorities are FIFO.
+        Commands issued by a thread that is already admitted run directly.
+        '''
+        if getattr(self._local, 'admitted', False):
+            return fcn(*args)
+        if policy is None:
+            policy = self.policy
+
+        self._acquire(priority)
+        try:
+            self._local.admitted = True
+            return self._run_with_retries(fcn, args, policy)
+        finally:
+            self._local.admitted = False
+            self._release()
+
+    def run_and_hold(self, fcn, args=(), priority=0, policy=None):
+        '''
+        Like run(), but the server stays admitted after fcn returns, e.g.
+        while a script it started without waiting runs; returns
+        (result, hold). No other command is admitted until hold.release()
+        is called, from any thread. hold is None if the calling thread was
+        already admitted (its own admission then covers the command).
+        '''
+        if getattr(self._local, 'admitted', False):
+            return fcn(*args), None
+        if policy is None:
+            policy = self.policy
+
+        self._acquire(priority)
+        try:
+            self._local.admitted = True
+            result = self._run_with_retries(fcn, args, policy)
+        except BaseException:
+            self._release()
+            raise
+        finally:
+            self._local.admitted = False
+        return result, Hold(self)
+
+    def _acquire(self, priority):
+        t0 = time.time()
+        ticket = (priority, next(self._counter))
+        with self._cond:
+            self.submitted += 1
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while self._busy or self._waiting[0] != ticket:
+                    self._cond.wait()
+            except BaseException:
+                # e.g. KeyboardInterrupt: a ticket left at the head would
+                # block every later command
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._busy = True
+
+        try:
+            if self._ipc_lock is not None:
+                self._ipc_lock.acquire()
+        except BaseException:
+            self._release_local()
+            raise
+        wait = time.time() - t0
+        self._local.wait = wait
+        self.total_wait += wait
+
+    def _release(self):
+        try:
+            if self._ipc_lock is not None:
+                self._ipc_lock.release()
+        finally:
+            self._release_local()
+
+    def _release_local(self):
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+    def _run_with_retries(self, fcn, args, policy):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fcn(*args)
+            except Exception as ex:
+                if not policy.is_retryable(ex):
+                    raise
+                if policy.max_attempts is not None and \
+                        attempt >= policy.max_attempts:
+                    raise
+
+            self.retries += 1
+            time.sleep(policy.delay(attempt))
+
+
+class Hold(object):
+    '''
+    Admission kept by AdmissionQueue.run_and_hold()
+
+    Used as a context manager by the thread finishing the held work: the
+    thread counts as admitted inside the block (so its commands run
+    directly), and the hold is released on exit.
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+        self._lock = threading.Lock()
+        self._held = True
+
+    def release(self):
+        '''Let the next command in (only the first call has an effect)'''
+        with self._lock:
+            if not self._held:
+                return
+            self._held = False
+        self.queue._release()
+
+    def __enter__(self):
+        self.queue._local.admitted = True
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.queue._local.admitted = False
+        self.release()
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(key, policy=None, interprocess=True):
+    '''The admission queue shared by all clients of the server `key`'''
+    with _queues_lock:
+        try:
+            return _queues[key]
+        except KeyError:
+            queue = _queues[key] = AdmissionQueue(key, policy=policy,
+                                                  interprocess=interprocess)
+            return queue
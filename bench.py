@@ -0,0 +1,627 @@
+"""
+pyzygo benchmarks
+
+> python bench.py [name ...]
+
+With no arguments, all benchmarks are run.
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+
+def timeit(fcn, repeat=5):
+    '''Best wall time of `repeat` calls to fcn()'''
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        fcn()
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parse(rows=100000, columns=4):
+    import random
+    import script_output
+
+    rng = random.Random(0)
+    lines = [', '.join('%.6g' % rng.uniform(-1e3, 1e3)
+                       for j in range(columns))
+             for i in range(rows)]
+    text = '\n'.join(lines).encode('latin-1')
+    for i in range(999, rows, 1000):
+        lines[i] = 'garbled \x00\x7f line %d' % i
+    lines.append('1.0, 2.0')  # truncated output
+    garbled = '\n'.join(lines).encode('latin-1')
+    kv_text = '\n'.join('key%d = %.6g' % (i, rng.random())
+                        for i in range(rows)).encode('latin-1')
+
+    def naive_floats():
+        values = []
+        for token in text.replace(b',', b' ').split():
+            try:
+                values.append(float(token))
+            except ValueError:
+                pass
+        return values
+
+    def naive_table():
+        rows = []
+        for line in text.splitlines():
+            try:
+                rows.append([float(token)
+                             for token in line.replace(b',', b' ').split()])
+            except ValueError:
+                pass
+        return rows
+
+    size_mb = len(text) / 1e6
+    print('parse: %d rows x %d columns, %.1f MB' % (rows, columns, size_mb))
+    for name, fcn in [('naive split/float', naive_floats),
+                      ('floats', lambda: script_output.parse_floats(text)),
+                      ('floats (garbled)',
+                       lambda: script_output.parse_floats(garbled)),
+                      ('naive table', naive_table),
+                      ('table', lambda: script_output.parse_table(text)),
+                      ('table (garbled)',
+                       lambda: script_output.parse_table(garbled)),
+                      ('kv', lambda: script_output.parse_kv(kv_text)),
+                      ]:
+        elapsed = timeit(fcn)
+        print('  %-20s %8.1f ms %8.1f MB/s' % (name, elapsed * 1e3,
+                                               size_mb / elapsed))
+
+
+def bench_result_store(rows=100000, days=7):
+    import shutil
+    import tempfile
+    import numpy as np
+    import result_store
+
+    path = tempfile.mkdtemp()
+    try:
+        day = 86400.
+        t0 = time.time() - days * day
+        store = result_store.ResultStore(path, batch_size=1024)
+        timestamps = t0 + np.sort(np.random.uniform(0, days * day, days * rows))
+        t_append = time.time()
+        for i, ts in enumerate(timestamps):
+            store.append(timestamp=ts, part_id='part%d' % (i % 500),
+                         stop_num=i, output='output %d' % i)
+        store.flush()
+        t_append = time.time() - t_append
+        print('result_store: %d rows appended in %.1f s (%.0f rows/s)' %
+              (len(store), t_append, len(store) / t_append))
+
+        t_open = timeit(lambda: result_store.ResultStore(path), repeat=1)
+        store = result_store.ResultStore(path)
+        print('  %-20s %8.2f ms' % ('open', t_open * 1e3))
+        start = t0 + 3 * day
+        count = len(store.query(start, start + day))
+        for name, fcn in [
+                ('query day', lambda: store.query(start, start + day)),
+                ('query day, 1 field',
+                 lambda: store.query(start, start + day,
+                                     fields=['stop_num'])),
+                ('query part', lambda: store.query(part_id='part7')),
+                ]:
+            elapsed = timeit(fcn)
+            print('  %-20s %8.2f ms' % (name, elapsed * 1e3))
+        print('  (%d rows in a day)' % count)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_daemon(count=200):
+    import threading
+    import zygo
+    import fake_mrc3
+    import mrc_daemon
+
+    # echoes each script as its output
+    server = fake_mrc3.FakeServer(
+        handler=lambda script: fake_mrc3.ScriptOutcome(output=script))
+    daemon = mrc_daemon.MRC3Daemon(('127.0.0.1', 0),
+                                   backend=fake_mrc3.FakeMRC3(server))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while daemon._server is None:
+        time.sleep(0.01)
+
+    def one_off_client():
+        client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(server))
+        client.run_script(script_text='print 1')
+        client.close()
+
+    def one_off_daemon():
+        client = mrc_daemon.DaemonClient(daemon.address)
+        client.run_script(script_text='print 1')
+        client.close()
+
+    warm = mrc_daemon.DaemonClient(daemon.address)
+    print('daemon: per-invocation latency (stand-in DLL)')
+    try:
+        for name, fcn in [('new MRC3Client', one_off_client),
+                          ('daemon, new conn', one_off_daemon),
+                          ('daemon, warm conn',
+                           lambda: warm.run_script(script_text='print 1')),
+                          ]:
+            elapsed = timeit(lambda: [fcn() for i in range(count)])
+            print('  %-20s %8.3f ms' % (name, elapsed * 1e3 / count))
+
+        # tools sharing the daemon's client must each get their own output
+        failures = []
+
+        def tool(i):
+            client = mrc_daemon.DaemonClient(daemon.address)
+            try:
+                for j in range(count // 4):
+                    text = 'print %d' % (i * count + j)
+                    try:
+                        output = client.run_script(script_text=text).output
+                    except Exception as ex:
+                        failures.append(ex)
+                    else:
+                        if output != text.encode('latin-1'):
+                            failures.append(output)
+            finally:
+                client.close()
+
+        tools = [threading.Thread(target=tool, args=(i, )) for i in range(4)]
+        for t in tools:
+            t.start()
+        for t in tools:
+            t.join()
+        print('  %-20s %5d of %d runs failed' % ('4 concurrent tools',
+                                                 len(failures),
+                                                 4 * (count // 4)))
+    finally:
+        warm.close()
+        daemon.shutdown()
+
+
+def _fake_client():
+    import zygo
+    import fake_mrc3
+    return zygo.MRC3Client(backend=fake_mrc3.FakeMRC3())
+
+
+def _analysis(client, size):
+    # stand-in for CPU-heavy, GIL-holding analysis of a measurement
+    total = 0.0
+    for i in range(size):
+        total += (i % 7) * 0.5
+    return total
+
+
+def _map_result(client, size):
+    import numpy as np
+    return np.ones((size, size))
+
+
+def bench_workers(jobs=8, size=500000, map_size=1024):
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor
+    import mrc_workers
+
+    cores = multiprocessing.cpu_count()
+    print('workers: %d analysis jobs per instrument, %d cores' % (jobs, cores))
+    counts = sorted(set([1, 2, 4, cores]))
+    for instruments in counts:
+        clients = [_fake_client() for i in range(instruments)]
+        with ThreadPoolExecutor(instruments) as pool:
+            t0 = time.time()
+            list(pool.map(lambda client: [_analysis(client, size)
+                                          for i in range(jobs)], clients))
+            threaded = time.time() - t0
+        for client in clients:
+            client.close()
+
+        with mrc_workers.WorkerSupervisor(
+                dict(('zygo%d' % i, _fake_client)
+                     for i in range(instruments))) as sup:
+            sup.map(_analysis, 0)['zygo0'].result()
+            t0 = time.time()
+            futures = [sup.map(_analysis, size) for i in range(jobs)]
+            [future.result() for batch in futures
+             for future in batch.values()]
+            workers = time.time() - t0
+
+        total = instruments * jobs
+        print('  %2d instruments: threads %6.1f jobs/s, workers %6.1f jobs/s' %
+              (instruments, total / threaded, total / workers))
+
+    for threshold, name in [(1 << 62, 'pickled'), (0, 'shared memory')]:
+        with mrc_workers.WorkerSupervisor({'zygo0': _fake_client},
+                                          shm_threshold=threshold) as sup:
+            elapsed = timeit(lambda: sup.submit('zygo0', _map_result,
+                                                map_size).result())
+        print('  %dx%d map, %-14s %8.2f ms' % (map_size, map_size, name,
+                                               elapsed * 1e3))
+
+
+def bench_import(modules=('mrc_common', 'mrc3_client', 'zygo', 'admission',
+                          'script_output', 'mrc_daemon'), repeat=5):
+    import subprocess
+
+    code = ('import time; t0 = time.time(); import %s; '
+            'print(time.time() - t0)')
+    print('import: fresh interpreter, best of %d' % repeat)
+    for module in modules:
+        best = None
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c',
+                                           code % module])
+            elapsed = float(out.decode('ascii').split()[-1])
+            if best is None or elapsed < best:
+                best = elapsed
+        print('  %-20s %8.2f ms' % (module, best * 1e3))
+
+
+class _CountingBackend(object):
+    '''Wraps a stand-in backend, counting mrc3_* calls by name'''
+    def __init__(self, backend):
+        import collections
+        self._backend = backend
+        self.calls = collections.Counter()
+
+    def __getattr__(self, name):
+        function = getattr(self._backend, name)
+
+        def counted(*args):
+            self.calls[name] += 1
+            return function(*args)
+        return counted
+
+
+def bench_script_result(count=1000):
+    import zygo
+    import fake_mrc3
+
+    backend = _CountingBackend(fake_mrc3.FakeMRC3())
+    client = zygo.MRC3Client(backend=backend, callbacks=False)
+    print('script_result: DLL calls per run_script (after the run itself)')
+    for name, fcn in [
+            ('nothing',
+             lambda: client.run_script(script_text='1', check=False)),
+            ('stop_float', lambda: client.run_script(script_text='1',
+                                                     check=False).stop_float),
+            ('output', lambda: client.run_script(script_text='1',
+                                                 check=False).output),
+            ('checked output',
+             lambda: client.run_script(script_text='1').output),
+            ]:
+        backend.calls.clear()
+        elapsed = timeit(lambda: [fcn() for i in range(count)], repeat=1)
+        fetches = sum(value for key, value in backend.calls.items()
+                      if key.startswith('mrc3_get_script_'))
+        print('  %-20s %5.2f calls %8.3f ms' % (name, fetches / float(count),
+                                                elapsed * 1e3 / count))
+    client.close()
+
+
+def _render(i):
+    return '\n'.join('print %d, sqrt(%d), %d * 2' % (j, i + j, j)
+                     for j in range(20))
+
+
+def bench_script_queue(count=300, duration=0.002, analysis_size=100):
+    '''
+    Each result is analysed by the caller (an SVD standing in for fitting
+    the parsed data); the queue overlaps that with the next script
+    '''
+    import numpy as np
+    import zygo
+    import fake_mrc3
+
+    matrix = np.random.RandomState(0).rand(analysis_size, analysis_size)
+
+    def analyse(result):
+        return np.linalg.svd(matrix + result.parsed[0, 0])
+
+    def handler(script):
+        return fake_mrc3.ScriptOutcome(output=b'\n'.join(
+            b'%d %.6f %d' % (i, i ** 0.5, i * 2) for i in range(30)))
+
+    print('script_queue: %d scripts of %.1f ms (stand-in DLL)' %
+          (count, duration * 1e3))
+    for callbacks in (True, False):
+        server = fake_mrc3.FakeServer(duration=duration, handler=handler)
+        client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(server),
+                                 callbacks=callbacks)
+
+        def sequential():
+            for i in range(count):
+                analyse(client.run_script(script_text=_render(i),
+                                          parse='table', fetch=['parsed']))
+
+        def queued():
+            queue = client.script_queue()
+            futures = [queue.submit(script_text=_render, i=i, parse='table',
+                                    fetch=['parsed'])
+                       for i in range(count)]
+            for future in futures:
+                analyse(future.result())
+
+        mode = 'callbacks' if callbacks else 'wait_idle'
+        for name, fcn in [('run_script', sequential),
+                          ('script_queue', queued)]:
+            elapsed = timeit(fcn, repeat=3)
+            print('  %-24s %7.3f ms/script, server busy %3.0f%%' %
+                  ('%s (%s)' % (name, mode), elapsed * 1e3 / count,
+                   100 * count * duration / elapsed))
+
+        stats = client.script_queue().stats()
+        print('  %-24s gap mean %.3f ms, p99 %.3f ms' %
+              ('', stats['mean'] * 1e3, stats['p99'] * 1e3))
+        client.close()
+
+
+def bench_replay(count=2000):
+    import os
+    import tempfile
+    import zygo
+    import fake_mrc3
+    import mrc_replay
+
+    def session(client):
+        for i in range(count):
+            client.run_script(script_text='print %d' % i, fetch=['output'])
+
+    fd, path = tempfile.mkstemp(suffix='.mrcrec')
+    os.close(fd)
+    try:
+        client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(), record=path)
+        session(client)
+        client.close()
+        print('replay: %d-script session, %d bytes recorded' %
+              (count, os.path.getsize(path)))
+
+        def replay():
+            client = zygo.MRC3Client(
+                backend=mrc_replay.ReplayMRC3(path, speed=None))
+            session(client)
+            client.close()
+
+        elapsed = timeit(replay, repeat=3)
+        print('  %-20s %8.1f us/script' % ('client overhead',
+                                           elapsed * 1e6 / count))
+    finally:
+        os.remove(path)
+
+
+def bench_callbacks(events=1000000):
+    import sys
+    import zygo
+    import fake_mrc3
+    import mrc3_client
+    import mrc_common
+
+    client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(), callbacks=False)
+    status = mrc_common.MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET
+    print('callbacks: SCAN_OFFSET events through _main_callback')
+
+    def report(name, fcn, count):
+        fcn(1000)
+        blocks = sys.getallocatedblocks()
+        elapsed = timeit(lambda: fcn(count), repeat=3)
+        allocated = (sys.getallocatedblocks() - blocks) / float(count * 3)
+        print('  %-20s %10.0f events/s %6.2f blocks/event' %
+              (name, count / elapsed, allocated))
+
+    try:
+        import _mrc3_callbacks
+    except ImportError:
+        print('  (_mrc3_callbacks not built: python setup.py build_ext -i)')
+    else:
+        _mrc3_callbacks.set_python_callback(client._main_callback)
+        report('C trampoline',
+               lambda n: _mrc3_callbacks.fire(1, status, n), events)
+        _mrc3_callbacks.set_python_callback(None)
+
+    trampoline = mrc3_client.mrc3_callback_type(client._main_callback)
+
+    def ctypes_events(n):
+        for i in range(n):
+            trampoline(1, status)
+
+    def python_events(n):
+        callback = client._main_callback
+        for i in range(n):
+            callback(1, status)
+
+    report('ctypes trampoline', ctypes_events, events // 10)
+    report('direct call', python_events, events)
+    client.close()
+
+
+def bench_scan_capture(events=1000000):
+    import sys
+    import zygo
+    import fake_mrc3
+    import scan_capture
+
+    client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(), callbacks=False)
+    status = scan_capture.SCAN_OFFSET_STATUS
+    print('scan_capture: %d SCAN_OFFSET events into one scan' % events)
+
+    def report(name, capture, fire):
+        capture.begin_scan()
+        blocks = sys.getallocatedblocks()
+        t0 = time.time()
+        fire()
+        elapsed = time.time() - t0
+        allocated = sys.getallocatedblocks() - blocks
+        scan = capture.end_scan()
+        capture.close()
+        print('  %-20s %10.0f events/s %6.2f blocks/event (%d kept)' %
+              (name, events / elapsed, allocated / float(events), scan.count))
+
+    try:
+        import _mrc3_callbacks
+    except ImportError:
+        print('  (_mrc3_callbacks not built: python setup.py build_ext -i)')
+    else:
+        _mrc3_callbacks.set_python_callback(client._main_callback)
+        report('extension', scan_capture.ScanCapture(
+            client, capacity=events, auto=False, use_extension=True),
+            lambda: _mrc3_callbacks.fire(1, status, events))
+        _mrc3_callbacks.set_python_callback(None)
+
+    def python_events():
+        callback = client._main_callback
+        for i in range(events):
+            callback(1, status)
+
+    report('Python callback', scan_capture.ScanCapture(
+        client, capacity=events, auto=False, use_extension=False),
+        python_events)
+    client.close()
+
+
+def bench_export(maps=100, size=256, codec='zlib', level=3):
+    import os
+    import tempfile
+    import numpy as np
+    import export
+
+    # smooth surfaces plus noise, quantized like real height maps
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    stack = np.empty((maps, size, size), np.float32)
+    for i in range(maps):
+        stack[i] = np.round((np.sin(6 * x + i) * np.cos(4 * y) * 50 +
+                             rng.normal(scale=0.5, size=x.shape)) * 8) / 8
+    mb = stack.nbytes / 1e6
+
+    cpus = os.cpu_count() or 1
+    counts = sorted(set([1, 2, 4, 8, 16, cpus]))
+    counts = [n for n in counts if n <= cpus] or [1]
+    print('export: %d maps of %dx%d (%.0f MB), %s level %d, %d cores' %
+          (maps, size, size, mb, codec, level, cpus))
+
+    fd, path = tempfile.mkstemp(suffix='.mrcx')
+    os.close(fd)
+    try:
+        def uncompressed():
+            with open(path, 'wb') as f:
+                np.save(f, stack)
+
+        elapsed = timeit(uncompressed, repeat=3)
+        print('  %-24s %8.1f MB/s' % ('np.save, uncompressed', mb / elapsed))
+
+        for processes in (False, True):
+            for workers in counts:
+                def run():
+                    with export.ExportWriter(path, codec=codec, level=level,
+                                             chunk_bytes=1 << 20,
+                                             workers=workers,
+                                             processes=processes) as writer:
+                        writer.add('maps', stack)
+                    return writer
+
+                elapsed = timeit(run, repeat=3)
+                ratio = stack.nbytes / float(os.path.getsize(path))
+                print('  %-24s %8.1f MB/s  ratio %.2f' % (
+                    '%d %s' % (workers, 'processes' if processes
+                               else 'threads'), mb / elapsed, ratio))
+
+        def per_map():
+            with export.ExportWriter(path, codec=codec, level=level,
+                                     workers=cpus) as writer:
+                for i in range(maps):
+                    writer.add('map%d' % i, stack[i])
+
+        elapsed = timeit(per_map, repeat=3)
+        print('  %-24s %8.1f MB/s' % ('%d threads, part per map' % cpus,
+                                      mb / elapsed))
+
+        def stacked():
+            with export.ExportWriter(path, codec=codec, level=level,
+                                     chunk_bytes=1 << 20,
+                                     workers=cpus) as writer:
+                writer.add('maps', stack)
+
+        stacked()
+        reader = export.ExportReader(path)
+        elapsed = timeit(lambda: reader.read('maps', rows=slice(50, 51)))
+        print('  %-24s %8.2f ms' % ('read one map', elapsed * 1e3))
+        elapsed = timeit(lambda: reader.read('maps'), repeat=3)
+        print('  %-24s %8.2f ms' % ('read all maps', elapsed * 1e3))
+        reader.close()
+    finally:
+        os.remove(path)
+
+
+def bench_completion(runs=8):
+    '''
+    Without callbacks: scripts of three typical lengths (+-10%), waited for
+    by polling script_running or by adaptive mrc3_wait_idle; latency is the
+    time from the end of the script to run_script returning
+    '''
+    import random
+    import zygo
+    import fake_mrc3
+
+    scripts = {'align': 0.03, 'measure': 0.15, 'stitch': 0.4}
+    rng = random.Random(0)
+    durations = []
+
+    def duration(script):
+        durations.append(scripts[script.decode('ascii')] *
+                         rng.uniform(0.9, 1.1))
+        return durations[-1]
+
+    print('completion: %d runs each of %s, callbacks=False' % (
+        runs, ', '.join('%s (%.0f ms)' % (name, seconds * 1e3)
+                        for name, seconds in sorted(scripts.items()))))
+    order = sorted(scripts) * runs
+    rng.shuffle(order)
+    for completion in ('poll', 'wait_idle'):
+        backend = _CountingBackend(fake_mrc3.FakeMRC3(
+            fake_mrc3.FakeServer(duration=duration)))
+        client = zygo.MRC3Client(backend=backend, callbacks=False,
+                                 completion=completion)
+        latencies = []
+        for name in order:
+            del durations[:]
+            start = time.perf_counter()
+            client.run_script(script_text=name)
+            latencies.append(time.perf_counter() - start - durations[0])
+        rpcs = backend.calls['mrc3_get_script_running'] + \
+            backend.calls['mrc3_wait_idle']
+        latencies.sort()
+        print('  %-10s latency mean %6.2f ms, max %6.2f ms, '
+              '%5.2f waiting RPCs/script' % (
+                  completion, sum(latencies) * 1e3 / len(latencies),
+                  latencies[-1] * 1e3, rpcs / float(len(order))))
+        client.close()
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'result_store': bench_result_store,
+    'daemon': bench_daemon,
+    'workers': bench_workers,
+    'import': bench_import,
+    'script_result': bench_script_result,
+    'script_queue': bench_script_queue,
+    'replay': bench_replay,
+    'callbacks': bench_callbacks,
+    'scan_capture': bench_scan_capture,
+    'export': bench_export,
+    'completion': bench_completion,
+}
+
+
+def main(names):
+    for name in (names or sorted(BENCHMARKS)):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,7 +1,15 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
+#ifdef _WIN32
 #include <windows.h>
+#else
+#include <dlfcn.h>
+#include <time.h>
+#define __stdcall
+#endif
 //#include "mrc3_client.h"
 
 #ifdef __cplusplus
@@ -13,25 +21,150 @@ typedef int (__stdcall mrc3_set_status_callback_function)(const int handle, mrc3
 }
 #endif
 
+#if PY_VERSION_HEX < 0x03090000
+#define PyObject_Vectorcall _PyObject_Vectorcall
+#endif
+
+#ifdef _WIN32
+#define atomic_inc(p) InterlockedIncrement64((volatile LONG64 *)(p))
+#define atomic_dec(p) InterlockedDecrement64((volatile LONG64 *)(p))
+#define atomic_load(p) InterlockedCompareExchange64((volatile LONG64 *)(p), 0, 0)
+#define atomic_store(p, v) InterlockedExchange64((volatile LONG64 *)(p), (v))
+#else
+#define atomic_inc(p) __atomic_add_fetch((p), 1, __ATOMIC_SEQ_CST)
+#define atomic_dec(p) __atomic_sub_fetch((p), 1, __ATOMIC_SEQ_CST)
+#define atomic_load(p) __atomic_load_n((p), __ATOMIC_SEQ_CST)
+#define atomic_store(p, v) __atomic_store_n((p), (v), __ATOMIC_SEQ_CST)
+#endif
+
 static PyObject *py_callback=NULL;
 
-void __stdcall main_callback(int id, int status) {
-    PyObject *arglist;
+// Timestamps of one status code (from one callback id, or any if id < 0)
+// captured straight into a buffer supplied by Python, without taking the
+// GIL; see capture()
+static struct {
+    Py_buffer view;
+    long long *data;
+    long long capacity;
+    long long status;
+    long long id;
+    volatile long long active;
+    volatile long long count;
+    volatile long long writers;
+} capture_state;
+
+// nanoseconds on the clock of time.perf_counter_ns()
+static long long monotonic_ns(void) {
+#ifdef _WIN32
+    static LARGE_INTEGER frequency;
+    LARGE_INTEGER counter;
+    if (!frequency.QuadPart)
+        QueryPerformanceFrequency(&frequency);
+    QueryPerformanceCounter(&counter);
+    return (long long)((double)counter.QuadPart * 1e9 / frequency.QuadPart);
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;
+#endif
+}
+
+static int capture_event(int id, int status) {
+    long long t, index;
+
+    if (!atomic_load(&capture_state.active) || status != capture_state.status ||
+        (capture_state.id >= 0 && id != capture_state.id))
+        return 0;
+
+    t = monotonic_ns();
+    atomic_inc(&capture_state.writers);
+    // re-check: capture() may have stopped in between
+    if (atomic_load(&capture_state.active)) {
+        index = atomic_inc(&capture_state.count) - 1;
+        if (index < capture_state.capacity)
+            capture_state.data[index] = t;
+    }
+    atomic_dec(&capture_state.writers);
+    return 1;
+}
+
+// Integer objects for recently seen ids and status codes, so that an event
+// allocates nothing: ids are fixed per interface and status codes are one of
+// the MRC_ENABLE_STATUS_CALLBACK_* bits
+#define LONG_CACHE_SIZE 16
+
+static struct {
+    long value;
+    PyObject *obj;
+} long_cache[LONG_CACHE_SIZE];
+static int long_cache_next = 0;
+
+static PyObject *cached_long(long value) {
+    int i;
+    PyObject *obj;
+
+    for (i = 0; i < LONG_CACHE_SIZE; i++) {
+        if (long_cache[i].obj && long_cache[i].value == value) {
+            Py_INCREF(long_cache[i].obj);
+            return long_cache[i].obj;
+        }
+    }
+
+    obj = PyLong_FromLong(value);
+    if (!obj)
+        return NULL;
+
+    i = long_cache_next;
+    long_cache_next = (long_cache_next + 1) % LONG_CACHE_SIZE;
+    Py_XDECREF(long_cache[i].obj);
+    Py_INCREF(obj);
+    long_cache[i].value = value;
+    long_cache[i].obj = obj;
+    return obj;
+}
+
+static void dispatch(int id, int status) {
+    // args[0] is scratch space for PY_VECTORCALL_ARGUMENTS_OFFSET, letting
+    // bound methods (MRC3Client._main_callback) prepend self in place
+    PyObject *args[3];
+    PyObject *callback;
     PyObject *result;
+
+    callback = py_callback;
+    if (!callback)
+        return;
+
+    // the callback may be replaced while it runs
+    Py_INCREF(callback);
+    args[0] = NULL;
+    args[1] = cached_long(id);
+    args[2] = cached_long(status);
+    if (args[1] && args[2]) {
+        result = PyObject_Vectorcall(callback, args + 1,
+                                     2 | PY_VECTORCALL_ARGUMENTS_OFFSET, NULL);
+        if (result)
+            Py_DECREF(result);
+        else
+            PyErr_WriteUnraisable(callback);
+    } else {
+        PyErr_WriteUnraisable(callback);
+    }
+    Py_XDECREF(args[1]);
+    Py_XDECREF(args[2]);
+    Py_DECREF(callback);
+}
+
+void __stdcall main_callback(int id, int status) {
     PyGILState_STATE gstate;
 
     //printf("cb %d %d\n", id, status);
+    if (capture_event(id, status))
+        return;
     if (!py_callback)
         return;
 
     gstate = PyGILState_Ensure();
-
-    arglist = Py_BuildValue("(ii)", id, status);
-    result =  PyEval_CallObject(py_callback, arglist);
-
-    Py_DECREF(arglist);
-    Py_XDECREF(result);
-
+    dispatch(id, status);
     PyGILState_Release(gstate);
 }
 
@@ -40,17 +173,19 @@ set_callback(PyObject *self, PyObject *args)
 {
     int mrc3_handle;
     int ret;
-    int _dll_handle;
-    HMODULE dll_handle;
+    PyObject *_dll_handle;
+    void *dll_handle;
     PyObject *temp;
     mrc3_set_status_callback_function *fcn;
-    if (!PyArg_ParseTuple(args, "iiO:set_callback", &_dll_handle, &mrc3_handle, &temp)) {
+    if (!PyArg_ParseTuple(args, "OiO:set_callback", &_dll_handle, &mrc3_handle, &temp)) {
         return NULL;
     }
-   
-    dll_handle = (HMODULE)_dll_handle;
-    if (dll_handle < 0) {
-        PyErr_SetString(PyExc_TypeError, "Invalid DLL handle");
+
+    // ctypes' CDLL._handle is pointer-sized; don't truncate it through int
+    dll_handle = PyLong_AsVoidPtr(_dll_handle);
+    if (!dll_handle) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_TypeError, "Invalid DLL handle");
         return NULL;
     }
 
@@ -58,35 +193,159 @@ set_callback(PyObject *self, PyObject *args)
         PyErr_SetString(PyExc_TypeError, "Parameter must be callable");
         return NULL;
     }
-    
+
     if (temp == Py_None)
         temp = NULL;
 
-    Py_XINCREF(temp);
-    Py_XDECREF(py_callback);
-    py_callback = temp;
-
-    // dll_handle = LoadLibrary(...);
-    fcn = (mrc3_set_status_callback_function*)GetProcAddress(dll_handle, 
+#ifdef _WIN32
+    fcn = (mrc3_set_status_callback_function*)GetProcAddress((HMODULE)dll_handle,
                                             "mrc3_set_status_callback_function");
+#else
+    fcn = (mrc3_set_status_callback_function*)dlsym(dll_handle,
+                                            "mrc3_set_status_callback_function");
+#endif
     if (!fcn) {
         PyErr_SetString(PyExc_TypeError, "GetProcAddress failed");
         return NULL;
     }
 
+    Py_XINCREF(temp);
+    Py_XDECREF(py_callback);
+    py_callback = temp;
+
     ret = fcn(mrc3_handle, main_callback);
-    return Py_BuildValue("i", ret);
+    return PyLong_FromLong(ret);
+}
+
+static PyObject *
+set_python_callback(PyObject *self, PyObject *temp)
+{
+    if (!PyCallable_Check(temp) && temp != Py_None) {
+        PyErr_SetString(PyExc_TypeError, "Parameter must be callable");
+        return NULL;
+    }
+
+    if (temp == Py_None)
+        temp = NULL;
+
+    Py_XINCREF(temp);
+    Py_XDECREF(py_callback);
+    py_callback = temp;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+fire(PyObject *self, PyObject *args)
+{
+    int id, status;
+    Py_ssize_t count = 1;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "ii|n:fire", &id, &status, &count)) {
+        return NULL;
+    }
+
+    for (i = 0; i < count; i++)
+        main_callback(id, status);
+    Py_RETURN_NONE;
+}
+
+static long long stop_capture(void) {
+    long long count;
+
+    if (!capture_state.data)
+        return 0;
+
+    atomic_store(&capture_state.active, 0);
+    // let events already writing into the buffer finish
+    while (atomic_load(&capture_state.writers))
+        ;
+    count = atomic_load(&capture_state.count);
+    capture_state.data = NULL;
+    PyBuffer_Release(&capture_state.view);
+    return count;
+}
+
+static PyObject *
+capture(PyObject *self, PyObject *args)
+{
+    PyObject *buffer;
+    int status = 0;
+    int id = -1;
+    long long count;
+
+    if (!PyArg_ParseTuple(args, "O|ii:capture", &buffer, &status, &id)) {
+        return NULL;
+    }
+
+    count = stop_capture();
+    if (buffer == Py_None)
+        return PyLong_FromLongLong(count);
+
+    if (PyObject_GetBuffer(buffer, &capture_state.view,
+                           PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+        return NULL;
+    if (capture_state.view.itemsize != sizeof(long long) ||
+        !capture_state.view.format ||
+        (strcmp(capture_state.view.format, "q") != 0 &&
+         strcmp(capture_state.view.format, "l") != 0)) {
+        PyBuffer_Release(&capture_state.view);
+        PyErr_SetString(PyExc_TypeError, "Buffer must be of 64-bit integers");
+        return NULL;
+    }
+
+    capture_state.data = (long long *)capture_state.view.buf;
+    capture_state.capacity = capture_state.view.len / sizeof(long long);
+    capture_state.status = status;
+    capture_state.id = id;
+    capture_state.count = 0;
+    atomic_store(&capture_state.active, 1);
+    return PyLong_FromLongLong(count);
+}
+
+static PyObject *
+capture_count(PyObject *self, PyObject *unused)
+{
+    return PyLong_FromLongLong(atomic_load(&capture_state.count));
+}
+
+static PyObject *
+py_monotonic_ns(PyObject *self, PyObject *unused)
+{
+    return PyLong_FromLongLong(monotonic_ns());
 }
 
 static PyMethodDef Methods[] =
 {
-     {"set_callback", set_callback, METH_VARARGS, "Set the Python callback."},
+     {"set_callback", set_callback, METH_VARARGS,
+      "set_callback(dll_handle, mrc3_handle, callable)\n\n"
+      "Register callable(callback_id, status) with the DLL."},
+     {"set_python_callback", set_python_callback, METH_O,
+      "Set the Python callback without registering it with a DLL."},
+     {"fire", fire, METH_VARARGS,
+      "fire(callback_id, status, count=1)\n\n"
+      "Call the trampoline `count` times, as the DLL would (benchmarks)."},
+     {"capture", capture, METH_VARARGS,
+      "capture(buffer, status, id=-1)\n\n"
+      "Write the time (ns) of each `status` event from callback `id` (any\n"
+      "if negative) into `buffer` (int64), instead of calling the Python\n"
+      "callback. capture(None) stops. There is a single capture slot.\n"
+      "Returns the number of events in the previous capture, which may\n"
+      "exceed its buffer's length (the excess was dropped)."},
+     {"capture_count", capture_count, METH_NOARGS,
+      "Events seen so far by the current capture."},
+     {"monotonic_ns", py_monotonic_ns, METH_NOARGS,
+      "The capture clock, in ns (that of time.perf_counter_ns)."},
      {NULL, NULL, 0, NULL}
 };
 
+static struct PyModuleDef module =
+{
+     PyModuleDef_HEAD_INIT, "_mrc3_callbacks", NULL, -1, Methods
+};
+
 PyMODINIT_FUNC
-init_mrc3_callbacks(void)
+PyInit__mrc3_callbacks(void)
 {
-     (void) Py_InitModule("_mrc3_callbacks", Methods);
+     return PyModule_Create(&module);
 }
-
@@ -0,0 +1,183 @@
+"""
+Script completion without status callbacks
+
+Where the callback extension is not available (callbacks=False), run_script
+could only block in mrc3_run_script(handle, TRUE) or poll script_running
+every poll_rate seconds; polling costs an RPC per poll and notices the end
+of a script up to poll_rate late.
+
+With completion='wait_idle', the script is started without waiting and the
+client waits in mrc3_wait_idle, which returns as soon as the interface goes
+idle. Each wait is bounded, so a stuck script or Ctrl-C is noticed between
+waits rather than never: the first timeout is set just past the duration
+expected from previous runs of the same script, and timeouts then grow
+geometrically up to max_timeout. A script that runs as usual therefore
+completes in a single wait, with no polling delay:
+
+    >>> client = MRC3Client(callbacks=False, completion='wait_idle')
+    >>> client.run_script(script_text='measure')
+
+ctypes releases the GIL for the duration of each DLL call, so other Python
+threads run while a client waits. With wait_done=False, the wait happens on
+a helper thread, which fetches and checks the result and then calls
+callback(result), if given. Failures are kept on the result, so that
+result.check() raises them; exceptions raised by the callback are logged.
+
+A script still running after max_wait seconds fails with
+MRC_ERR_TIMEOUT_WAITING_FOR_SCRIPT; MetroPro keeps running it.
+"""
+
+from __future__ import print_function
+import collections
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mrc_common
+from zygo import MRC3ClientError
+
+COMPLETIONS = ('block', 'poll', 'wait_idle')
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveWait(object):
+    '''
+    Waits for scripts of one client with bounded, growing mrc3_wait_idle
+    timeouts, learning each script's duration
+
+    initial: first timeout for a script not seen before, in seconds
+    growth: factor applied to the timeout after each wait times out
+    max_timeout: longest single wait, in seconds
+    margin: fraction added to the expected duration for the first timeout
+    alpha: weight of the latest run in the per-script duration average
+    max_tracked: number of distinct scripts whose durations are kept
+    max_wait: longest total wait for a script, in seconds (None: no limit)
+    '''
+    def __init__(self, client, initial=0.05, growth=2.0, max_timeout=1.0,
+                 margin=0.2, alpha=0.3, max_tracked=1024, max_wait=3600.0):
+        self.client = client
+        self.initial = initial
+        self.growth = growth
+        self.max_timeout = max_timeout
+        self.margin = margin
+        self.alpha = alpha
+        self.max_tracked = max_tracked
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._durations = collections.OrderedDict()
+        self._helper = None
+
+        self.waits = 0
+        self.rpcs = 0
+        self.timeouts = 0
+
+    def expected(self, key):
+        '''Average duration of script `key` (text or filename), or None'''
+        with self._lock:
+            return self._durations.get(key)
+
+    def _learn(self, key, duration):
+        with self._lock:
+            # the script text itself is the key, as in script_files
+            average = self._durations.pop(key, None)
+            if average is not None:
+                duration = average + self.alpha * (duration - average)
+            self._durations[key] = duration
+            if len(self._durations) > self.max_tracked:
+                self._durations.popitem(last=False)
+
+    def _first_timeout(self, key):
+        average = self.expected(key)
+        if average is None:
+            return self.initial
+        return min(self.max_timeout,
+                   max(average * (1 + self.margin), self.initial / 4))
+
+    def wait(self, key, start=None):
+        '''
+        Wait until the script `key`, started at perf_counter() time `start`,
+        has finished; returns its duration in seconds
+
+        Raises MRC3ClientError (MRC_ERR_TIMEOUT_WAITING_FOR_SCRIPT) once
+        max_wait seconds have passed since `start`.
+        '''
+        client = self.client
+        handle = client._handle
+        if start is None:
+            start = time.perf_counter()
+        deadline = None if self.max_wait is None else start + self.max_wait
+        timeout = self._first_timeout(key)
+        with self._lock:
+            self.waits += 1
+        while True:
+            if deadline is not None:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    raise MRC3ClientError(
+                        'Script still running after %g s' % self.max_wait,
+                        mrc_common.MRC_ERR_TIMEOUT_WAITING_FOR_SCRIPT)
+                timeout = min(timeout, left)
+            with self._lock:
+                self.rpcs += 1
+            try:
+                client._wait_idle(handle, max(1, int(timeout * 1e3)))
+                break
+            except MRC3ClientError as ex:
+                if ex.code != mrc_common.MRC_ERR_TIMEOUT_WAITING_FOR_IDLE:
+                    raise
+            with self._lock:
+                self.timeouts += 1
+            timeout = min(self.max_timeout, timeout * self.growth)
+
+        duration = time.perf_counter() - start
+        self._learn(key, duration)
+        return duration
+
+    def wait_async(self, key, start, hold, callback, result, fetch=(),
+                   check=False):
+        '''
+        On the helper thread: wait, fetch the `fetch` fields of `result`
+        and check it (if `check`), release `hold` (admission.Hold, or None)
+        and call callback(result), if given
+
+        A failure is kept on the result (result.check() raises it) and the
+        callback is still called.
+        '''
+        if self._helper is None:
+            self._helper = ThreadPoolExecutor(1)
+
+        def finish():
+            try:
+                with hold or contextlib.nullcontext():
+                    self.wait(key, start)
+                    # while admitted, before another script replaces the
+                    # results in the DLL
+                    result.fetch(*fetch)
+                    if check:
+                        result.check()
+            except Exception as ex:
+                result._fail(ex)
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    logger.exception('Script callback %r failed', callback)
+
+        return self._helper.submit(finish)
+
+    def stats(self):
+        with self._lock:
+            return {'waits': self.waits, 'rpcs': self.rpcs,
+                    'timeouts': self.timeouts,
+                    'rpcs_per_wait': self.rpcs / float(self.waits)
+                    if self.waits else float('nan'),
+                    'scripts': len(self._durations)}
+
+    def close(self):
+        if self._helper is not None:
+            self._helper.shutdown(wait=True)
+            self._helper = None
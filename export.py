@@ -0,0 +1,274 @@
+"""
+Parallel, chunked, compressed export of measurement batches
+
+ExportWriter splits each array (e.g. a stack of maps) into chunks of about
+`chunk_bytes` along its first axis and compresses them in a thread or
+process pool, writing them to a single container file in order as they
+complete. Chunks of successive parts share the pool, so a batch exported as
+many small parts (one per map or result) compresses as fast as one stack.
+An index at the end of the file records every part's dtype, shape and
+chunks, so ExportReader can read one part, or a range of rows of it,
+decompressing only the chunks involved:
+
+    >>> with ExportWriter('shift.mrcx', codec='zlib', level=3) as writer:
+    ...     writer.add('maps', maps)
+    ...     writer.add_store('results', store)
+    >>> ExportReader('shift.mrcx').read('maps', rows=slice(10, 20))
+
+A writer left by an exception (`with` block) closes the file without an
+index, so the incomplete container is refused by ExportReader rather than
+read as if it held every part.
+
+Layout:
+    MAGIC
+    chunk data
+    index (JSON)
+    index offset (uint64) + MAGIC
+"""
+
+from __future__ import print_function
+import collections
+import json
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MAGIC = b'MRCX0001'
+_footer = struct.Struct('<Q8s')
+
+CODECS = ('zlib', 'bz2', 'lzma', 'none')
+
+
+class ExportError(Exception): pass
+
+
+def _codec_module(codec):
+    if codec == 'zlib':
+        import zlib
+        return zlib
+    elif codec == 'bz2':
+        import bz2
+        return bz2
+    elif codec == 'lzma':
+        import lzma
+        return lzma
+    raise ExportError('Unknown codec %r (one of %s)' %
+                      (codec, ', '.join(CODECS)))
+
+
+def compress(data, codec, level):
+    '''Compress one chunk (module level so that process pools can use it)'''
+    if codec == 'none':
+        return bytes(data)
+    module = _codec_module(codec)
+    if codec == 'lzma':
+        return module.compress(data, preset=level)
+    return module.compress(data, level)
+
+
+def decompress(data, codec):
+    if codec == 'none':
+        return data
+    return _codec_module(codec).decompress(data)
+
+
+class ExportWriter(object):
+    '''
+    Writes parts to a chunked, compressed container
+
+    codec: one of CODECS; level: its compression level
+    chunk_bytes: approximate uncompressed size of a chunk
+    workers: pool size (default: os.cpu_count())
+    processes: compress in a process pool rather than a thread pool; zlib,
+        bz2 and lzma release the GIL, so threads usually suffice
+    '''
+    def __init__(self, path, codec='zlib', level=6, chunk_bytes=4 << 20,
+                 workers=None, processes=False):
+        if codec not in CODECS:
+            raise ExportError('Unknown codec %r (one of %s)' %
+                              (codec, ', '.join(CODECS)))
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self.chunk_bytes = chunk_bytes
+        self.workers = workers or os.cpu_count() or 1
+        self._processes = processes
+        if processes:
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(self.workers)
+        else:
+            self._pool = ThreadPoolExecutor(self.workers)
+
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._index = {}
+        # (future, chunk) compressing, oldest first, across parts
+        self._pending = collections.deque()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _write_oldest(self):
+        # chunks are written in order, as their compression completes
+        future, chunk = self._pending.popleft()
+        data = future.result()
+        self._file.write(data)
+        chunk[2:] = [self._offset, len(data)]
+        self._offset += len(data)
+        self.bytes_out += len(data)
+
+    def add(self, name, array, attrs=None):
+        '''Add an array (rows along the first axis) as part `name`'''
+        if name in self._index:
+            raise ExportError('Part %r already written' % (name, ))
+        # not ascontiguousarray, which makes 0-d arrays 1-d
+        array = np.asarray(array, order='C')
+        if array.dtype.hasobject:
+            raise ExportError('Cannot export object arrays (part %r)' %
+                              (name, ))
+
+        shape = array.shape if array.ndim else (1, )
+        flat = array.reshape(shape)
+        row_bytes = max(1, flat[:1].nbytes)
+        rows_per_chunk = max(1, self.chunk_bytes // row_bytes)
+
+        # [first row, end row, offset, compressed size]; the last two are
+        # filled in when the chunk is written, by a later add() or close()
+        chunks = []
+        for start in range(0, max(1, shape[0]), rows_per_chunk):
+            end = min(shape[0], start + rows_per_chunk)
+            data = flat[start:end].reshape(-1).view(np.uint8)
+            chunks.append([start, end, None, None])
+            self.bytes_in += data.nbytes
+            # a copy, as the caller may reuse the array once add() returns
+            # (cheap next to compressing it)
+            data = data.tobytes()
+            # bounded so that a large batch is not held in memory all at once
+            if len(self._pending) >= 2 * self.workers:
+                self._write_oldest()
+            future = self._pool.submit(compress, data, self.codec, self.level)
+            self._pending.append((future, chunks[-1]))
+
+        self._index[name] = {'dtype': array.dtype.str,
+                             'shape': list(array.shape),
+                             'codec': self.codec, 'chunks': chunks,
+                             'attrs': attrs or {}}
+
+    def add_store(self, name, store, fields=None):
+        '''Add the columns of a result_store.ResultStore as `name`/<field>'''
+        for field in store.dtype.names:
+            if fields is None or field in fields:
+                self.add('%s/%s' % (name, field), store.column(field))
+
+    def close(self):
+        if self._file is None:
+            return
+        while self._pending:
+            self._write_oldest()
+        self._pool.shutdown(wait=True)
+        index = json.dumps(self._index).encode('utf-8')
+        self._file.write(index)
+        self._file.write(_footer.pack(self._offset, MAGIC))
+        self._file.close()
+        self._file = None
+
+    def abort(self):
+        '''Close the file without an index, marking it incomplete'''
+        if self._file is None:
+            return
+        self._pending.clear()
+        self._pool.shutdown(wait=True)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ExportReader(object):
+    '''Reads parts, or rows of parts, from a container written by ExportWriter'''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ExportError('%s is not an export container' % path)
+
+        size = self._file.seek(0, os.SEEK_END)
+        magic = None
+        if size >= len(MAGIC) + _footer.size:
+            self._file.seek(-_footer.size, os.SEEK_END)
+            index_offset, magic = _footer.unpack(
+                self._file.read(_footer.size))
+        if magic != MAGIC:
+            raise ExportError('%s is incomplete or truncated (no index)' %
+                              path)
+        end = size - _footer.size
+        self._file.seek(index_offset)
+        self.index = json.loads(
+            self._file.read(end - index_offset).decode('utf-8'))
+
+    def names(self):
+        return sorted(self.index)
+
+    def attrs(self, name):
+        return self.index[name]['attrs']
+
+    def _read_chunk(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def read(self, name, rows=None):
+        '''
+        Part `name`, or only rows[start:stop] of it (a slice with step 1);
+        only the chunks overlapping the rows are read and decompressed
+        '''
+        try:
+            part = self.index[name]
+        except KeyError:
+            raise ExportError('No part %r in %s' % (name, self.path))
+        dtype = np.dtype(part['dtype'])
+        shape = tuple(part['shape'])
+        nrows = shape[0] if shape else 1
+
+        start, stop = 0, nrows
+        if rows is not None:
+            start, stop, step = rows.indices(nrows)
+            if step != 1:
+                raise ExportError('Row slices must be contiguous')
+        stop = max(start, stop)
+
+        out = np.empty((stop - start, ) + shape[1:], dtype)
+        flat = out.reshape(-1).view(np.uint8) if out.size else None
+        row_bytes = dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+        for first, end, offset, size in part['chunks']:
+            if end <= start or first >= stop:
+                continue
+            data = decompress(self._read_chunk(offset, size), part['codec'])
+            chunk = np.frombuffer(data, np.uint8)
+            lo, hi = max(first, start), min(end, stop)
+            flat[(lo - start) * row_bytes:(hi - start) * row_bytes] = \
+                chunk[(lo - first) * row_bytes:(hi - first) * row_bytes]
+
+        if not shape:
+            return out.reshape(())
+        return out
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
@@ -0,0 +1,427 @@
+"""
+Stand-in for the mrc3_client DLL
+
+FakeMRC3 provides the mrc3_* functions with the same signatures and return
+codes as the DLL, so that MRC3Client(backend=FakeMRC3(...)) runs without
+MetroPro (or Windows). All FakeMRC3 instances sharing a FakeServer see
+MetroPro's one-command-at-a-time semantics: a command issued while another
+client's script is running fails with MRC_ERR_SERVER_BUSY.
+
+Scripts are "run" by a handler, called with the script text (or the contents
+of the script file) and returning a ScriptOutcome; by default every script
+succeeds with empty output after `duration` seconds. A script file that does
+not exist fails at once with script error ERROR_FILE_NOT_FOUND, without
+reaching the handler.
+"""
+
+from __future__ import print_function
+import collections
+import ctypes
+import itertools
+import os
+import threading
+import time
+
+import mrc_common
+
+ScriptOutcome = collections.namedtuple('ScriptOutcome',
+                                       'output error stop_num stop_str')
+ScriptOutcome.__new__.__defaults__ = (b'', mrc_common.MRC_ERR_NONE, 0.0, b'')
+
+FAKE_GUID = b'00000000-0000-0000-0000-000000000000'
+
+# winerror.h
+ERROR_FILE_NOT_FOUND = 2
+
+_error_names = dict((value, name) for name, value in vars(mrc_common).items()
+                    if name.startswith('MRC_ERR_') and name != 'MRC_ERR_BASE')
+
+
+def _deref(arg):
+    '''The object behind a ctypes.byref()/pointer argument'''
+    obj = getattr(arg, '_obj', None)
+    if obj is not None:
+        return obj
+    contents = getattr(arg, 'contents', None)
+    if contents is not None:
+        return contents
+    return arg
+
+
+def _value(arg):
+    arg = _deref(arg)
+    return getattr(arg, 'value', arg)
+
+
+def _to_bytes(arg):
+    '''A c_char_p argument; like ctypes, refuses str'''
+    arg = _value(arg)
+    if arg is None:
+        return b''
+    if not isinstance(arg, bytes):
+        raise ctypes.ArgumentError('expected bytes, %s found' %
+                                   type(arg).__name__)
+    return arg
+
+
+def _write_string(buf, size, data):
+    ctypes.memmove(buf, data[:size - 1] + b'\0', min(len(data) + 1, size))
+
+
+def default_handler(script):
+    return ScriptOutcome()
+
+
+class FakeServer(object):
+    '''
+    The simulated MetroPro instance
+
+    duration: script run time in seconds, or a callable(script) -> seconds
+    handler: callable(script) -> ScriptOutcome
+    transition_time: time taken by request_control()/release_control() when
+        the state actually changes
+    lock: lock object guarding the "one command at a time" state
+    '''
+    def __init__(self, duration=0.0, handler=default_handler,
+                 transition_time=0.0, state=mrc_common.MRC_SERVER_STATE_IDLE,
+                 lock=None):
+        self.duration = duration
+        self.handler = handler
+        self.transition_time = transition_time
+        self.state = state
+        self._lock = lock if lock is not None else threading.Lock()
+        self._busy_with = None
+        self.commands = 0
+        self.busy_errors = 0
+
+    def script_duration(self, script):
+        if callable(self.duration):
+            return self.duration(script)
+        return self.duration
+
+    def begin_command(self, owner):
+        '''Claim the server for a command; returns an MRC error code'''
+        with self._lock:
+            if self.state == mrc_common.MRC_SERVER_STATE_STOPPED:
+                return mrc_common.MRC_ERR_RUN_SCRIPT_FAILED
+            if self._busy_with is not None:
+                self.busy_errors += 1
+                return mrc_common.MRC_ERR_SERVER_BUSY
+            self._busy_with = owner
+            self.commands += 1
+            return mrc_common.MRC_ERR_NONE
+
+    def end_command(self, owner):
+        with self._lock:
+            if self._busy_with is owner:
+                self._busy_with = None
+
+
+class SharedFakeServer(FakeServer):
+    '''
+    FakeServer whose state is shared with child processes
+
+    Pass it to multiprocessing.Process (of the same `context`) to have
+    clients in several processes compete for one simulated MetroPro.
+    duration and handler must then be picklable.
+    '''
+    def __init__(self, duration=0.0, handler=default_handler,
+                 transition_time=0.0, state=mrc_common.MRC_SERVER_STATE_IDLE,
+                 context=None):
+        if context is None:
+            import multiprocessing as context
+        self._shared_state = context.Value('i', state, lock=False)
+        self._shared_owner = context.Value('q', 0, lock=False)
+        self._shared_commands = context.Value('q', 0, lock=False)
+        self._shared_busy_errors = context.Value('q', 0, lock=False)
+        FakeServer.__init__(self, duration=duration, handler=handler,
+                            transition_time=transition_time, state=state,
+                            lock=context.Lock())
+
+    def _shared_value(name):
+        def get(self):
+            return getattr(self, name).value
+
+        def set_(self, value):
+            getattr(self, name).value = value
+        return property(get, set_)
+
+    state = _shared_value('_shared_state')
+    commands = _shared_value('_shared_commands')
+    busy_errors = _shared_value('_shared_busy_errors')
+    del _shared_value
+
+    @staticmethod
+    def _owner_id(owner):
+        return (os.getpid() << 24) | owner.handle
+
+    def begin_command(self, owner):
+        with self._lock:
+            if self.state == mrc_common.MRC_SERVER_STATE_STOPPED:
+                return mrc_common.MRC_ERR_RUN_SCRIPT_FAILED
+            if self._shared_owner.value:
+                self.busy_errors += 1
+                return mrc_common.MRC_ERR_SERVER_BUSY
+            self._shared_owner.value = self._owner_id(owner)
+            self.commands += 1
+            return mrc_common.MRC_ERR_NONE
+
+    def end_command(self, owner):
+        with self._lock:
+            if self._shared_owner.value == self._owner_id(owner):
+                self._shared_owner.value = 0
+
+
+class _Interface(object):
+    def __init__(self, handle):
+        self.handle = handle
+        self.params = None
+        self.script_filename = b''
+        self.script_text = b''
+        self.context = mrc_common.MRC_SCRIPT_CONTEXT_FRONTMOST_APP
+        self.callback = None
+        self.callback_mask = mrc_common.MRC_ENABLE_STATUS_CALLBACK_NONE
+        self.callback_id = 0
+        self.outcome = ScriptOutcome()
+        self.idle = threading.Event()
+        self.idle.set()
+
+
+class FakeMRC3(object):
+    '''Stand-in for the mrc3_client DLL, talking to a FakeServer'''
+    _handles = itertools.count(1)
+
+    def __init__(self, server=None):
+        if server is None:
+            server = FakeServer()
+        self.server = server
+        self._interfaces = {}
+
+    def _get(self, handle):
+        return self._interfaces.get(_value(handle))
+
+    def _fire(self, iface, mask, status):
+        '''Call back with status code `status` if `mask` is enabled'''
+        if iface.callback is not None and (iface.callback_mask & mask):
+            iface.callback(iface.callback_id, status)
+
+    # startup / cleanup
+    def mrc3_get_interface_guid(self, result, size):
+        _write_string(result, size, FAKE_GUID)
+
+    def mrc3_new_interface(self, handle):
+        iface = _Interface(next(self._handles))
+        self._interfaces[iface.handle] = iface
+        _deref(handle).value = iface.handle
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_free_interface(self, handle):
+        ref = _deref(handle)
+        if self._interfaces.pop(ref.value, None) is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        ref.value = mrc_common.MRC_INVALID_HANDLE
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_set_interface_params(self, handle, protocol_sequence,
+                                  network_address, end_point):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not _to_bytes(protocol_sequence) or not _to_bytes(end_point):
+            return mrc_common.MRC_ERR_INVALID_PARAM
+        iface.params = (protocol_sequence, network_address, end_point)
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_ping_server(self, handle):
+        if self._get(handle) is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        return mrc_common.MRC_ERR_NONE
+
+    # control
+    def _set_state(self, handle, state):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not iface.idle.is_set():
+            return mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY
+        err = self.server.begin_command(iface)
+        if err != mrc_common.MRC_ERR_NONE:
+            return err
+        try:
+            if self.server.state != state:
+                time.sleep(self.server.transition_time)
+                self.server.state = state
+        finally:
+            self.server.end_command(iface)
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_request_control(self, handle):
+        return self._set_state(handle, mrc_common.MRC_SERVER_STATE_ACTIVE)
+
+    def mrc3_release_control(self, handle):
+        return self._set_state(handle, mrc_common.MRC_SERVER_STATE_IDLE)
+
+    def mrc3_wait_idle(self, handle, timeout_millisecs):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        timeout = _value(timeout_millisecs)
+        if not iface.idle.wait(timeout / 1000. if timeout > 0 else None):
+            return mrc_common.MRC_ERR_TIMEOUT_WAITING_FOR_IDLE
+        return mrc_common.MRC_ERR_NONE
+
+    # status
+    def mrc3_get_server_state(self, handle, result):
+        if self._get(handle) is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        _deref(result).value = self.server.state
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_get_error_message(self, err, result, size):
+        name = _error_names.get(_value(err), 'Unknown error')
+        _write_string(result, size, name.encode('ascii'))
+
+    # scripts
+    def _set_script(self, handle, attr, value):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not iface.idle.is_set():
+            return mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY
+        setattr(iface, attr, value)
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_set_script_filename(self, handle, filename):
+        return self._set_script(handle, 'script_filename', _to_bytes(filename))
+
+    def mrc3_set_script_text(self, handle, text):
+        return self._set_script(handle, 'script_text', _to_bytes(text))
+
+    def mrc3_set_script_context(self, handle, context):
+        return self._set_script(handle, 'context', _value(context))
+
+    def _run(self, iface, script, duration):
+        try:
+            time.sleep(duration)
+            if script is None:
+                outcome = ScriptOutcome(error=ERROR_FILE_NOT_FOUND)
+            else:
+                outcome = self.server.handler(script)
+            if outcome is None:
+                outcome = ScriptOutcome()
+            iface.outcome = outcome
+        finally:
+            self.server.end_command(iface)
+            iface.idle.set()
+        self._fire(iface, mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_SCRIPT,
+                   mrc_common.MRC_CALLBACK_STATUS_END_SCRIPT)
+
+    def mrc3_run_script(self, handle, wait_done):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not iface.idle.is_set():
+            return mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY
+        if iface.script_filename:
+            # MetroPro reads script files itself
+            try:
+                with open(iface.script_filename, 'rb') as f:
+                    script = f.read()
+            except (IOError, OSError):
+                script = None
+        elif iface.script_text:
+            script = iface.script_text
+        else:
+            return mrc_common.MRC_ERR_NO_SCRIPT_FILENAME_OR_TEXT
+
+        err = self.server.begin_command(iface)
+        if err != mrc_common.MRC_ERR_NONE:
+            return err
+
+        iface.idle.clear()
+        duration = self.server.script_duration(script) \
+            if script is not None else 0.0
+        if _value(wait_done):
+            self._run(iface, script, duration)
+        else:
+            thread = threading.Thread(target=self._run,
+                                      args=(iface, script, duration))
+            thread.daemon = True
+            thread.start()
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_start_script(self, handle):
+        return self.mrc3_run_script(handle, False)
+
+    def _script_result(self, handle, result, value):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not iface.idle.is_set():
+            return mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY
+        _deref(result).value = value(iface.outcome)
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_get_script_running(self, handle, result):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        _deref(result).value = 0 if iface.idle.is_set() else 1
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_get_script_error(self, handle, result):
+        return self._script_result(handle, result,
+                                   lambda outcome: outcome.error)
+
+    def mrc3_get_script_stop_num_val(self, handle, result):
+        return self._script_result(handle, result,
+                                   lambda outcome: outcome.stop_num)
+
+    def _script_string(self, handle, result, size, value):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        if not iface.idle.is_set():
+            return mrc_common.MRC_ERR_CLIENT_INTERFACE_BUSY
+        _write_string(result, _value(size), value(iface.outcome))
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_get_script_output(self, handle, result, size):
+        return self._script_string(handle, result, size,
+                                   lambda outcome: outcome.output)
+
+    def mrc3_get_script_stop_str_val(self, handle, result, size):
+        return self._script_string(handle, result, size,
+                                   lambda outcome: outcome.stop_str)
+
+    # callbacks
+    def mrc3_set_status_callback_function(self, handle, function):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        iface.callback = function
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_set_status_callback_mask(self, handle, bitmask):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        iface.callback_mask = _value(bitmask)
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_set_status_callback_id(self, handle, callback_id):
+        iface = self._get(handle)
+        if iface is None:
+            return mrc_common.MRC_ERR_INVALID_HANDLE
+        iface.callback_id = _value(callback_id)
+        return mrc_common.MRC_ERR_NONE
+
+    # logging
+    def mrc3_open_log_file(self, pathname):
+        return mrc_common.MRC_ERR_NONE
+
+    def mrc3_close_log_file(self):
+        pass
+
+    def mrc3_log_message(self, message):
+        pass
@@ -0,0 +1,291 @@
+"""
+Load test: many simulated clients against one stand-in MetroPro
+
+Each client runs an MRC3Client workload (scripts separated by think time)
+against a fake_mrc3 server with MetroPro's one-command-at-a-time semantics
+and log-normally distributed script durations. Clients are threads or
+processes:
+
+    > python loadtest.py --clients 1,2,4,8,16 --mode processes \\
+    ...     --duration-median 0.05 --think 0.2 --time 10
+
+For each client count, the report gives throughput, script latency
+(p50/p99), time spent queued before the script ran, the rate of
+MRC_ERR_SERVER_BUSY replies and the server's utilization. With admission
+(the default), busy replies are rare and the cost of contention shows up as
+queueing time; with --no-admission, clients retry busy errors themselves.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import threading
+import time
+
+import mrc_common
+
+ADMISSION_END_POINT = 'loadtest-%d'
+
+
+class LognormalDuration(object):
+    '''Script duration, in seconds: log-normal around `median`'''
+    def __init__(self, median=0.05, sigma=0.5):
+        self.median = median
+        self.sigma = sigma
+
+    def __call__(self, script):
+        if self.sigma <= 0:
+            return self.median
+        return random.lognormvariate(0, self.sigma) * self.median
+
+
+class Workload(object):
+    '''
+    What each simulated client does
+
+    scripts: scripts per client (None: run until `seconds` have passed)
+    think: mean think time between scripts, exponentially distributed
+    session: hold control for the whole run (client.session())
+    '''
+    def __init__(self, scripts=None, seconds=10.0, think=0.1, session=False,
+                 admission=True, fetch=('output', ),
+                 script_text='print "load", %d'):
+        self.scripts = scripts
+        self.seconds = seconds
+        self.think = think
+        self.session = session
+        self.admission = admission
+        self.fetch = fetch
+        self.script_text = script_text
+
+
+def _retry_busy(fcn, policy):
+    '''
+    Call fcn(), retrying MRC_ERR_SERVER_BUSY as a client without admission
+    would; returns (busy_replies, time of the attempt that ran)
+    '''
+    import zygo
+
+    busy = 0
+    attempt = time.time()
+    while True:
+        try:
+            fcn()
+            return busy, attempt
+        except zygo.MRC3ClientError as ex:
+            if ex.code != mrc_common.MRC_ERR_SERVER_BUSY:
+                raise
+        busy += 1
+        time.sleep(policy.delay(busy))
+        attempt = time.time()
+
+
+def _run_client(server, workload, index, end_point, start):
+    '''Run one client; returns [(latency, queued, busy_errors, ok), ...]'''
+    import zygo
+    import fake_mrc3
+    import admission
+
+    rng = random.Random(index)
+    policy = admission.RetryPolicy(max_attempts=None)
+    client = zygo.MRC3Client(backend=fake_mrc3.FakeMRC3(server),
+                             end_point=end_point, callbacks=False,
+                             admission=workload.admission,
+                             retry_policy=policy)
+    samples = []
+    try:
+        # all clients start together
+        time.sleep(max(0, start - time.time()))
+        if workload.session:
+            _retry_busy(client.session().enter, policy)
+        deadline = start + workload.seconds
+        count = 0
+        while True:
+            if workload.scripts is not None:
+                if count >= workload.scripts:
+                    break
+            elif time.time() >= deadline:
+                break
+            count += 1
+
+            text = workload.script_text % count
+            t0 = time.time()
+            try:
+                busy, attempt = _retry_busy(
+                    lambda: client.run_script(script_text=text,
+                                              fetch=workload.fetch), policy)
+                ok = True
+            except zygo.MRC3ClientError:
+                busy, attempt, ok = 0, t0, False
+            latency = time.time() - t0
+            if workload.admission:
+                queued = client._admission.last_wait
+            else:
+                # time lost to busy replies before the attempt that ran
+                queued = attempt - t0
+            samples.append((latency, queued, busy, ok))
+
+            if workload.think:
+                time.sleep(rng.expovariate(1.0 / workload.think))
+        if workload.session:
+            client.session().exit()
+    finally:
+        _retry_busy(client.close, policy)
+    return samples
+
+
+def _process_main(server, workload, index, end_point, start, results):
+    try:
+        results.put((index, _run_client(server, workload, index, end_point,
+                                        start)))
+    except Exception as ex:
+        results.put((index, ex))
+
+
+def run(clients, workload, duration=None, mode='threads', start_method=None):
+    '''
+    Run `clients` simulated clients to completion; returns a Report
+
+    duration: fake_mrc3 duration (seconds or callable), default
+        LognormalDuration()
+    mode: 'threads' or 'processes'
+    '''
+    import fake_mrc3
+
+    if duration is None:
+        duration = LognormalDuration()
+    end_point = ADMISSION_END_POINT % os.getpid()
+    start = time.time() + 0.5
+
+    if mode == 'threads':
+        server = fake_mrc3.FakeServer(duration=duration)
+        samples = [None] * clients
+
+        def target(index):
+            try:
+                samples[index] = _run_client(server, workload, index,
+                                             end_point, start)
+            except Exception as ex:
+                samples[index] = ex
+
+        threads = [threading.Thread(target=target, args=(i, ))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elif mode == 'processes':
+        import multiprocessing
+        ctx = multiprocessing.get_context(start_method)
+        # process start-up is slower; give every client time to connect
+        start += 0.5 + 0.05 * clients
+        server = fake_mrc3.SharedFakeServer(duration=duration, context=ctx)
+        results = ctx.Queue()
+        processes = [ctx.Process(target=_process_main,
+                                 args=(server, workload, i, end_point, start,
+                                       results))
+                     for i in range(clients)]
+        for process in processes:
+            process.start()
+        samples = [None] * clients
+        for i in range(clients):
+            index, value = results.get()
+            samples[index] = value
+        for process in processes:
+            process.join()
+    else:
+        raise ValueError('Unknown mode %r' % (mode, ))
+
+    wall = time.time() - start
+    for value in samples:
+        if isinstance(value, Exception):
+            raise value
+    return Report(clients, [s for client in samples for s in client], wall,
+                  server.commands, server.busy_errors)
+
+
+def _percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Report(object):
+    def __init__(self, clients, samples, wall, commands, busy_errors):
+        self.clients = clients
+        self.wall = wall
+        self.scripts = sum(1 for s in samples if s[3])
+        self.failures = len(samples) - self.scripts
+        self.latencies = [s[0] for s in samples if s[3]]
+        self.queued = [s[1] for s in samples if s[3]]
+        self.commands = commands
+        self.busy_errors = busy_errors
+
+    @property
+    def throughput(self):
+        return self.scripts / self.wall
+
+    @property
+    def busy_rate(self):
+        '''Fraction of command attempts rejected with MRC_ERR_SERVER_BUSY'''
+        attempts = self.commands + self.busy_errors
+        return self.busy_errors / float(attempts) if attempts else 0.0
+
+    @property
+    def utilization(self):
+        '''Fraction of the run the server spent on scripts (approximate)'''
+        return (sum(self.latencies) - sum(self.queued)) / self.wall
+
+    HEADER = ('%7s %10s %9s %9s %9s %9s %7s %7s %8s' %
+              ('clients', 'scripts/s', 'p50 ms', 'p99 ms', 'queue ms',
+               'q p99 ms', 'busy %', 'util %', 'failures'))
+
+    def row(self):
+        return '%7d %10.2f %9.1f %9.1f %9.1f %9.1f %7.1f %7.1f %8d' % (
+            self.clients, self.throughput,
+            _percentile(self.latencies, 0.5) * 1e3,
+            _percentile(self.latencies, 0.99) * 1e3,
+            sum(self.queued) / max(1, len(self.queued)) * 1e3,
+            _percentile(self.queued, 0.99) * 1e3,
+            self.busy_rate * 100, self.utilization * 100, self.failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', default='1,2,4,8,16',
+                        help='comma-separated client counts to run')
+    parser.add_argument('--mode', choices=('threads', 'processes'),
+                        default='threads')
+    parser.add_argument('--time', type=float, default=5.0,
+                        help='seconds per run')
+    parser.add_argument('--scripts', type=int, default=None,
+                        help='scripts per client (instead of --time)')
+    parser.add_argument('--duration-median', type=float, default=0.05,
+                        help='median script duration, seconds')
+    parser.add_argument('--duration-sigma', type=float, default=0.5,
+                        help='log-normal sigma of script durations')
+    parser.add_argument('--think', type=float, default=0.1,
+                        help='mean think time between scripts, seconds')
+    parser.add_argument('--session', action='store_true',
+                        help='each client holds a control session')
+    parser.add_argument('--no-admission', action='store_true',
+                        help='clients retry busy errors themselves')
+    args = parser.parse_args()
+
+    workload = Workload(scripts=args.scripts, seconds=args.time,
+                        think=args.think, session=args.session,
+                        admission=not args.no_admission)
+    duration = LognormalDuration(args.duration_median, args.duration_sigma)
+    print('%s, scripts %.0f ms median, think %.0f ms, %s' % (
+        args.mode, args.duration_median * 1e3, args.think * 1e3,
+        'admission' if workload.admission else 'no admission'))
+    print(Report.HEADER)
+    for clients in [int(n) for n in args.clients.split(',')]:
+        report = run(clients, workload, duration, mode=args.mode)
+        print(report.row())
+
+
+if __name__ == '__main__':
+    main()
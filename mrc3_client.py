@@ -1,4 +1,43 @@
 from ctypes import *
+import ctypes
+
+# Function prototypes are only built (with WINFUNCTYPE) the first time they
+# are used, so importing this module is cheap and works on platforms without
+# WINFUNCTYPE (where CFUNCTYPE is used instead; there is no DLL to call there,
+# but stand-in backends can still be used).
+
+class _LazyType(object):
+    _type = None
+
+    @property
+    def type(self):
+        if self._type is None:
+            self._type = self._build()
+        return self._type
+
+
+class _prototype(_LazyType):
+    def __init__(self, restype, *argtypes):
+        self.restype = restype
+        self.argtypes = argtypes
+
+    def _build(self):
+        functype = getattr(ctypes, 'WINFUNCTYPE', CFUNCTYPE)
+        argtypes = [arg.type if isinstance(arg, _LazyType) else arg
+                    for arg in self.argtypes]
+        return functype(self.restype, *argtypes)
+
+    def __call__(self, *args):
+        return self.type(*args)
+
+
+class _pointer(_LazyType):
+    def __init__(self, target):
+        self.target = target
+
+    def _build(self):
+        return POINTER(self.target.type)
+
 
 # Callback function type.
 # While running a script for a remote client, a server can call back to the client to indicate a status change.
@@ -8,7 +47,7 @@ from ctypes import *
 # \param status
 # Input: integer, one of the MRC_CALLBACK_STATUS_XXX status codes defined in mrc_common.h.
 # \sa mrc3_set_status_callback_function().
-mrc3_callback_type = WINFUNCTYPE(None, c_int, c_int)
+mrc3_callback_type = _prototype(None, c_int, c_int)
 
 # Opens a diagnostic log file.
 # This function opens a log file to receive diagnostic messages.
@@ -19,16 +58,16 @@ mrc3_callback_type = WINFUNCTYPE(None, c_int, c_int)
 # If successful, returns zero. Otherwise, returns a non-zero error code. See \ref error_codes.\n
 # \remarks
 # Only a single log file is supported.
-mrc3_open_log_file = WINFUNCTYPE(c_int, c_char_p)
+mrc3_open_log_file = _prototype(c_int, c_char_p)
 
 # Closes a diagnostic log file.
 # This function closes the diagnostic log file that was opened by OpenLogFile().
-mrc3_close_log_file = WINFUNCTYPE(None)
+mrc3_close_log_file = _prototype(None)
 
 # Writes a message to a diagnostic log file.
 # This function writes a message to a diagnostic log file that was opened by OpenLogFile().
 # This function does nothing if there is no open log file.
-mrc3_log_message = WINFUNCTYPE(None, c_char_p)
+mrc3_log_message = _prototype(None, c_char_p)
 
 # Get the GUID (Globally Unique Identifier) for the RPC interface.
 # \param result
@@ -38,7 +77,7 @@ mrc3_log_message = WINFUNCTYPE(None, c_char_p)
 # This function gets a string representation of the GUID (Globally Unique Identifier) for the RPC interface.
 # For successful communication with MetroPro, the GUID must match MetroPro's GUID.
 # This is useful as a diagnostic to determine if the client DLL version and the MetroPro version are compatible.
-mrc3_get_interface_guid = WINFUNCTYPE(None, c_char_p, c_int)
+mrc3_get_interface_guid = _prototype(None, c_char_p, c_int)
 
 # Create a new interface for communication with a server.
 # \param handle
@@ -57,7 +96,7 @@ mrc3_get_interface_guid = WINFUNCTYPE(None, c_char_p, c_int)
 # This function fails if:
 # - The handle is a NULL pointer.
 # - Memory could not be allocated.
-mrc3_new_interface = WINFUNCTYPE(c_int, POINTER(c_int))
+mrc3_new_interface = _prototype(c_int, POINTER(c_int))
 
 # Free an interface previously created by function mrc3_new_interface().
 # \param handle
@@ -73,7 +112,7 @@ mrc3_new_interface = WINFUNCTYPE(c_int, POINTER(c_int))
 # This function fails if:
 # - The handle is a NULL pointer.
 # - The handle is invalid.
-mrc3_free_interface = WINFUNCTYPE(c_int, POINTER(c_int))
+mrc3_free_interface = _prototype(c_int, POINTER(c_int))
 
 # Set interface parameters for communication with a server.
 # \param handle
@@ -99,7 +138,7 @@ mrc3_free_interface = WINFUNCTYPE(c_int, POINTER(c_int))
 # - The handle is invalid.
 # - The interface parameters are invalid or inconsistent.
 # .
-mrc3_set_interface_params = WINFUNCTYPE(c_int, c_int, c_char_p, c_char_p,  c_char_p)
+mrc3_set_interface_params = _prototype(c_int, c_int, c_char_p, c_char_p,  c_char_p)
 
 # Ping a server.
 # \param handle
@@ -114,7 +153,7 @@ mrc3_set_interface_params = WINFUNCTYPE(c_int, c_int, c_char_p, c_char_p,  c_cha
 # - The server MetroPro is not available.
 # - There is a communication error.
 # .
-mrc3_ping_server = WINFUNCTYPE(c_int, c_int)
+mrc3_ping_server = _prototype(c_int, c_int)
 
 # Request control of a server.
 # \param handle
@@ -133,7 +172,7 @@ mrc3_ping_server = WINFUNCTYPE(c_int, c_int)
 # - There is a communication error.
 # - MetroPro cannot transition to the active state.
 # .
-mrc3_request_control = WINFUNCTYPE(c_int, c_int)
+mrc3_request_control = _prototype(c_int, c_int)
 
 # Release control of a server.
 # \param handle
@@ -150,7 +189,7 @@ mrc3_request_control = WINFUNCTYPE(c_int, c_int)
 # - The server MetroPro is not available.
 # - There is a communication error.
 # .
-mrc3_release_control = WINFUNCTYPE(c_int, c_int)
+mrc3_release_control = _prototype(c_int, c_int)
 
 # Get the state of a server.
 # \param handle
@@ -167,7 +206,7 @@ mrc3_release_control = WINFUNCTYPE(c_int, c_int)
 # - The server MetroPro is not available.
 # - There is a communication error.
 # .
-mrc3_get_server_state = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
+mrc3_get_server_state = _prototype(c_int, c_int, POINTER(c_int))
 
 # Sets a script filename.
 # This function sets the name of a MetroScript file that can be subsequently run by the server MetroPro.
@@ -185,7 +224,7 @@ mrc3_get_server_state = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
 # - The handle is invalid.
 # - The client interface is not idle.
 # .
-mrc3_set_script_filename = WINFUNCTYPE(c_int, c_int, c_char_p)
+mrc3_set_script_filename = _prototype(c_int, c_int, c_char_p)
 
 # Sets script text.
 # This function sets MetroScript text that can be subsequently run by the server MetroPro.
@@ -203,7 +242,7 @@ mrc3_set_script_filename = WINFUNCTYPE(c_int, c_int, c_char_p)
 # - The handle is invalid.
 # - The client interface is not idle.
 # .
-mrc3_set_script_text = WINFUNCTYPE(c_int, c_int, c_char_p)
+mrc3_set_script_text = _prototype(c_int, c_int, c_char_p)
 
 # Sets the script context.
 # This function sets the context in which a script will run.
@@ -220,7 +259,7 @@ mrc3_set_script_text = WINFUNCTYPE(c_int, c_int, c_char_p)
 # - The handle is invalid.
 # - The client interface is not idle.
 # .
-mrc3_set_script_context = WINFUNCTYPE(c_int, c_int, c_int)
+mrc3_set_script_context = _prototype(c_int, c_int, c_int)
 
 # Assigns a status callback function.
 # This function assigns a function that can be called to indicate a change
@@ -239,7 +278,7 @@ mrc3_set_script_context = WINFUNCTYPE(c_int, c_int, c_int)
 # - The client interface is not idle.
 # .
 # \sa mrc3_set_status_callback_mask() and mrc3_set_status_callback_id().
-mrc3_set_status_callback_function = WINFUNCTYPE(c_int, c_int, POINTER(mrc3_callback_type))
+mrc3_set_status_callback_function = _prototype(c_int, c_int, _pointer(mrc3_callback_type))
 
 # Enables or disables specific callbacks.
 # While running a script for a client, a server can call back to the client to indicate a status change.
@@ -256,7 +295,7 @@ mrc3_set_status_callback_function = WINFUNCTYPE(c_int, c_int, POINTER(mrc3_callb
 # - The handle is invalid.
 # - The client interface is not idle.
 # .
-mrc3_set_status_callback_mask = WINFUNCTYPE(c_int, c_int, c_int)
+mrc3_set_status_callback_mask = _prototype(c_int, c_int, c_int)
 
 # Sets a status callback ID.
 # This function assigns an integer value that will be passed to the
@@ -276,7 +315,7 @@ mrc3_set_status_callback_mask = WINFUNCTYPE(c_int, c_int, c_int)
 # - The client interface is not idle.
 # .
 # \sa mrc3_set_status_callback_function() and mrc3_set_status_callback_mask().
-mrc3_set_status_callback_id = WINFUNCTYPE(c_int, c_int, c_int) 
+mrc3_set_status_callback_id = _prototype(c_int, c_int, c_int) 
 
 # Runs a script on the server.
 # This function causes the server MetroPro to start running a script and
@@ -310,7 +349,7 @@ mrc3_set_status_callback_id = WINFUNCTYPE(c_int, c_int, c_int)
 # .
 # \sa
 # mrc3_start_script()
-mrc3_run_script = WINFUNCTYPE(c_int, c_int, c_bool)
+mrc3_run_script = _prototype(c_int, c_int, c_bool)
 
 # Starts a script on the server.
 # This function causes the server MetroPro to start running a script without waiting for completion.
@@ -320,7 +359,7 @@ mrc3_run_script = WINFUNCTYPE(c_int, c_int, c_bool)
 # \return
 # If successful, returns zero. Otherwise, returns a non-zero error code. See \ref error_codes.\n
 # See the remarks for function mrc3_run_script().
-mrc3_start_script = WINFUNCTYPE(c_int, c_int)
+mrc3_start_script = _prototype(c_int, c_int)
 
 # Tests if the interface is currently running a script.
 # \param handle
@@ -332,7 +371,7 @@ mrc3_start_script = WINFUNCTYPE(c_int, c_int)
 # This function fails if:
 # - The handle is invalid.
 # .
-mrc3_get_script_running = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
+mrc3_get_script_running = _prototype(c_int, c_int, POINTER(c_int))
 
 # Waits until the client interface is idle.
 # An idle client interface is neither running a script nor is in use by another thread.
@@ -349,7 +388,7 @@ mrc3_get_script_running = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
 # - The handle is invalid.
 # - The timeout period is exceeded.
 # .
-mrc3_wait_idle = WINFUNCTYPE(c_int, c_int, c_int)
+mrc3_wait_idle = _prototype(c_int, c_int, c_int)
 
 # Gets the error code from the last script run.
 # \param handle
@@ -362,7 +401,7 @@ mrc3_wait_idle = WINFUNCTYPE(c_int, c_int, c_int)
 # This function fails if:
 # - The client interface is not idle.
 # .
-mrc3_get_script_error = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
+mrc3_get_script_error = _prototype(c_int, c_int, POINTER(c_int))
 
 # Gets the text output from the last script run.
 # \param handle
@@ -377,7 +416,7 @@ mrc3_get_script_error = WINFUNCTYPE(c_int, c_int, POINTER(c_int))
 # This function fails if:
 # - The client interface is not idle.
 # .
-mrc3_get_script_output = WINFUNCTYPE(c_int, c_int, c_char_p, c_int)
+mrc3_get_script_output = _prototype(c_int, c_int, c_char_p, c_int)
 
 # Gets the stop string value from the last script run.
 # \param handle
@@ -393,7 +432,7 @@ mrc3_get_script_output = WINFUNCTYPE(c_int, c_int, c_char_p, c_int)
 # - The client interface is not idle.
 # .
 # \sa script_stop_values
-mrc3_get_script_stop_str_val = WINFUNCTYPE(c_int, c_int, c_char_p, c_int)
+mrc3_get_script_stop_str_val = _prototype(c_int, c_int, c_char_p, c_int)
 
 # Gets the stop numeric value from the last script run.
 # \param handle
@@ -407,7 +446,7 @@ mrc3_get_script_stop_str_val = WINFUNCTYPE(c_int, c_int, c_char_p, c_int)
 # - The client interface is not idle.
 # .
 # \sa script_stop_values
-mrc3_get_script_stop_num_val = WINFUNCTYPE(c_int, c_int, POINTER(c_double)) # NOTE: pointer wasn't specified?
+mrc3_get_script_stop_num_val = _prototype(c_int, c_int, POINTER(c_double)) # NOTE: pointer wasn't specified?
 
 # Get a message string corresponding to an error code.
 # \param err
@@ -417,7 +456,7 @@ mrc3_get_script_stop_num_val = WINFUNCTYPE(c_int, c_int, POINTER(c_double)) # NO
 # \param size
 # Input: Size of result[] array.\n
 # This function gets a message string corresponding to an integer error code.
-mrc3_get_error_message = WINFUNCTYPE(None, c_int, c_char_p, c_int)
+mrc3_get_error_message = _prototype(None, c_int, c_char_p, c_int)
 
 __all__ = [
     # callback type
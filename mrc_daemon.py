@@ -0,0 +1,415 @@
+"""
+Local daemon holding warm MRC3Client handles
+
+Short-lived tools would otherwise pay for loading the DLL, binding every
+mrc3_* function, creating and configuring an interface, pinging the server
+and enabling callbacks on every invocation. The daemon does that once per
+server and serves script requests over a localhost socket, so a one-off
+tool pays a single local round trip:
+
+    > python mrc_daemon.py --port 7735
+
+    >>> client = DaemonClient()
+    >>> client.run_script(script_text='print sqrt(2)', parse='floats').parsed
+
+Messages are single lines of JSON in each direction. Callback events are
+streamed to connections that send {"op": "subscribe"}.
+
+The daemon's client is shared by every tool, so a result is only that of
+the caller's script while the script is admitted: pass the fields needed
+(including stop values) in run_script's `fetch`.
+
+Anyone who can connect can run scripts, so the daemon only listens on
+loopback addresses unless a shared-secret token is configured; every
+request must then carry it:
+
+    > python mrc_daemon.py --host 0.0.0.0 --token-file secret.txt
+
+    >>> client = DaemonClient(('metropro-pc', 7735), token=secret)
+"""
+
+from __future__ import print_function
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+    import queue
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
+
+from script_result import FIELDS, ScriptResult
+
+DEFAULT_ADDRESS = ('127.0.0.1', 7735)
+
+# result fields sent back as JSON; 'parsed' is computed by the client
+FETCHABLE = frozenset(FIELDS) - frozenset(['parsed'])
+
+
+class DaemonError(Exception):
+    def __init__(self, message='', code=None, type_=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.type = type_
+
+
+def _encode(msg):
+    return (json.dumps(msg) + '\n').encode('utf-8')
+
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+
+def is_loopback(host):
+    '''Whether every address `host` resolves to is a loopback address'''
+    try:
+        infos = socket.getaddrinfo(host or None, None, 0, socket.SOCK_STREAM,
+                                   0, socket.AI_PASSIVE)
+    except socket.gaierror:
+        return False
+    addresses = [info[4][0].split('%')[0] for info in infos]
+    return bool(addresses) and all(
+        ipaddress.ip_address(address).is_loopback for address in addresses)
+
+
+class MRC3Daemon(object):
+    '''
+    Owns one warm MRC3Client per server, created on first use
+
+    client_factory: callable(protocol, host, end_point) -> MRC3Client;
+        by default zygo.MRC3Client with `client_kwargs`
+    token: shared secret every request must carry; required to listen on
+        anything but a loopback address
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, client_factory=None,
+                 token=None, **client_kwargs):
+        if token is None and not is_loopback(address[0]):
+            raise DaemonError('Refusing to listen on %s without a token: '
+                              'anyone who can connect could run scripts' %
+                              (address[0] or 'all interfaces'))
+        self.address = address
+        self.token = token
+        self._client_factory = client_factory
+        self._client_kwargs = client_kwargs
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        self._server = None
+
+    def _new_client(self, protocol, host, end_point):
+        if self._client_factory is not None:
+            return self._client_factory(protocol, host, end_point)
+
+        import zygo
+        return zygo.MRC3Client(protocol=protocol, host=host,
+                               end_point=end_point, **self._client_kwargs)
+
+    def get_client(self, protocol='ncalrpc', host='', end_point='localhost'):
+        key = (protocol, host, end_point)
+        with self._clients_lock:
+            try:
+                return self._clients[key]
+            except KeyError:
+                pass
+            client = self._new_client(*key)
+            # published before other threads can get the client
+            for callback_id in client._callbacks:
+                client.add_callback_function(
+                    callback_id, self._make_publisher(key, callback_id))
+            self._clients[key] = client
+            return client
+
+    def _make_publisher(self, key, status):
+        def publish(callback_id):
+            event = {'event': status, 'id': callback_id, 'server': key,
+                     'time': time.time()}
+            with self._subscribers_lock:
+                for subscriber in self._subscribers:
+                    subscriber.put(event)
+        return publish
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self._subscribers_lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._subscribers_lock:
+            self._subscribers.remove(subscriber)
+
+    def authorized(self, msg):
+        if self.token is None:
+            return True
+        token = msg.get('token')
+        return isinstance(token, str) and \
+            hmac.compare_digest(token.encode('utf-8'),
+                                self.token.encode('utf-8'))
+
+    def handle(self, msg):
+        '''Handle a single request, returning the response message'''
+        op = msg.get('op')
+        if op == 'ping':
+            return {'ok': True}
+
+        client = self.get_client(**msg.get('server', {}))
+        if op == 'run_script':
+            kwargs = msg.get('args', {})
+            fetch = msg.get('fetch', ())
+            unknown = set(fetch) - FETCHABLE
+            if unknown:
+                raise ValueError('Cannot fetch %s (one of %s)' % (
+                    ', '.join(sorted(unknown)), ', '.join(sorted(FETCHABLE))))
+            # the client is shared by every connection: fields are read
+            # under the script's admission, before another script can run
+            result = client.run_script(fetch=fetch, **kwargs)
+            values = dict((field, _to_text(value))
+                          for field, value in result.fetched().items())
+            return {'ok': True, 'result': values}
+        elif op == 'state':
+            return {'ok': True, 'result': client.state}
+        elif op in ('request_control', 'release_control'):
+            getattr(client, op)()
+            return {'ok': True}
+        raise ValueError('Unknown op: %r' % (op, ))
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        msg = json.loads(line.decode('utf-8'))
+                    except ValueError as ex:
+                        self.wfile.write(_encode({'ok': False,
+                                                  'error': str(ex)}))
+                        continue
+
+                    if not isinstance(msg, dict) or \
+                            not daemon.authorized(msg):
+                        self.wfile.write(_encode({
+                            'ok': False, 'error': 'Not authorized',
+                            'type': 'PermissionError'}))
+                        return
+
+                    if msg.get('op') == 'subscribe':
+                        self.stream_events()
+                        return
+
+                    try:
+                        response = daemon.handle(msg)
+                    except Exception as ex:
+                        response = {'ok': False, 'error': str(ex),
+                                    'code': getattr(ex, 'code', None),
+                                    'type': ex.__class__.__name__}
+                    self.wfile.write(_encode(response))
+
+            def stream_events(self):
+                subscriber = daemon.subscribe()
+                try:
+                    self.wfile.write(_encode({'ok': True}))
+                    while True:
+                        self.wfile.write(_encode(subscriber.get()))
+                except (IOError, OSError):
+                    pass
+                finally:
+                    daemon.unsubscribe(subscriber)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server(self.address, Handler)
+        self.address = self._server.server_address
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+        with self._clients_lock:
+            for client in self._clients.values():
+                try:
+                    client.close()
+                except Exception as ex:
+                    print('Failed to close client: %s' % ex)
+            self._clients.clear()
+
+
+class DaemonClient(object):
+    '''
+    Thin client mirroring MRC3Client.run_script through the daemon
+
+    The server to use is selected by protocol/host/end_point, as with
+    MRC3Client. token: the daemon's shared secret, if it has one.
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, protocol='ncalrpc', host='',
+                 end_point='localhost', timeout=None, token=None):
+        self.address = tuple(address)
+        self.server = {'protocol': protocol, 'host': host,
+                       'end_point': end_point}
+        self.timeout = timeout
+        self.token = token
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rwb')
+
+    def _request(self, msg):
+        msg.setdefault('server', self.server)
+        if self.token is not None:
+            msg['token'] = self.token
+        with self._lock:
+            if self._sock is None:
+                self._sock, self._file = self._connect()
+            try:
+                self._file.write(_encode(msg))
+                self._file.flush()
+                line = self._file.readline()
+            except (IOError, OSError):
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise DaemonError('Connection closed by daemon')
+
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise DaemonError(response.get('error'), response.get('code'),
+                              response.get('type'))
+        return response.get('result')
+
+    def ping(self):
+        return self._request({'op': 'ping'})
+
+    def run_script(self, script_filename='', script_text='', wait_done=True,
+                   poll_completion=False, poll_rate=0.1, parse=None,
+                   priority=None, fetch=('output', ), check=True,
+                   completion=None):
+        '''
+        See MRC3Client.run_script
+
+        The result is detached from the daemon: only the fields in `fetch`
+        are available (e.g. fetch=['stop_float'] for the stop value; there
+        is no separate stop value request, as the daemon's last script may
+        be another tool's). Parsing is done locally.
+        '''
+        args = {'script_filename': script_filename,
+                'script_text': script_text, 'wait_done': wait_done,
+                'poll_completion': poll_completion, 'poll_rate': poll_rate,
+                'priority': priority, 'completion': completion}
+        fetch = set(fetch)
+        if 'parsed' in fetch:
+            fetch.remove('parsed')
+            fetch.add('output')
+        if check:
+            fetch.update(['error', 'error_message'])
+
+        values = self._request({'op': 'run_script', 'args': args,
+                                'fetch': sorted(fetch)})
+        for field in ('output', 'stop_str', 'error_message'):
+            if field in values:
+                values[field] = values[field].encode('latin-1')
+
+        result = ScriptResult(parse=parse, **values)
+        if check:
+            result.check()
+        return result
+
+    @property
+    def state(self):
+        return self._request({'op': 'state'})
+
+    def request_control(self):
+        return self._request({'op': 'request_control'})
+
+    def release_control(self):
+        return self._request({'op': 'release_control'})
+
+    def events(self):
+        '''Generator of callback events (dicts), on its own connection'''
+        sock, f = self._connect()
+        try:
+            msg = {'op': 'subscribe'}
+            if self.token is not None:
+                msg['token'] = self.token
+            f.write(_encode(msg))
+            f.flush()
+            response = json.loads(f.readline().decode('utf-8') or '{}')
+            if not response.get('ok'):
+                raise DaemonError(response.get('error',
+                                               'Connection closed by daemon'),
+                                  type_=response.get('type'))
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
+        finally:
+            f.close()
+            sock.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default=DEFAULT_ADDRESS[0],
+                        help='address to listen on (default: localhost); '
+                        'other than loopback, requires a token')
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--token-file',
+                        help='file holding the shared secret clients must '
+                        'send (default: $MRC_DAEMON_TOKEN, if set)')
+    parser.add_argument('--path', default='.', help='mrc3_client.dll path')
+    parser.add_argument('--dllname', default='mrc3_client.dll')
+    parser.add_argument('--no-callbacks', action='store_true')
+    parser.add_argument('--fake', action='store_true',
+                        help='use the fake_mrc3 stand-in instead of the DLL')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    kwargs = dict(path=args.path, dllname=args.dllname, debug=args.debug,
+                  callbacks=not args.no_callbacks)
+    if args.fake:
+        import fake_mrc3
+        kwargs['backend'] = fake_mrc3.FakeMRC3()
+
+    token = os.environ.get('MRC_DAEMON_TOKEN') or None
+    if args.token_file:
+        with open(args.token_file) as f:
+            token = f.read().strip()
+    try:
+        daemon = MRC3Daemon((args.host, args.port), token=token, **kwargs)
+    except DaemonError as ex:
+        parser.error(str(ex))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Record and replay of mrc3_* call traffic
+
+A client created with MRC3Client(record='session.mrcrec') writes every
+mrc3_* call to the file: its arguments (as they were after the call, so
+output buffers are included), return code, start time and duration, and
+the thread that made it. Status callbacks are recorded where they fell
+between calls.
+
+ReplayMRC3 is a backend that plays a recording back in place of the DLL,
+on any platform:
+
+    >>> client = MRC3Client(backend=ReplayMRC3('session.mrcrec', speed=10))
+
+Each call returns the next recorded result for that function, after the
+recorded duration divided by `speed` (speed=None: no delay), and recorded
+callbacks are fired at their recorded offsets. Timing the client against a
+replay gives its own overhead, so versions can be compared on the same
+production session:
+
+    > python mrc_replay.py session.mrcrec
+
+The file is a gzip stream of small binary records.
+"""
+
+from __future__ import print_function
+import collections
+import ctypes
+import gzip
+import heapq
+import struct
+import threading
+import time
+
+import mrc_common
+
+MAGIC = b'MRCREC1\n'
+
+# local to the client; never sent to the server
+NOT_RECORDED = frozenset(['mrc3_set_status_callback_function'])
+
+_NAME, _CALL, _EVENT = b'N', b'C', b'E'
+_name_header = struct.Struct('<HB')
+_call_header = struct.Struct('<HHddB')
+_event_record = struct.Struct('<dqq')
+_int, _float, _len = struct.Struct('<q'), struct.Struct('<d'), \
+    struct.Struct('<I')
+
+
+class ReplayError(Exception): pass
+
+
+Call = collections.namedtuple('Call', 'seq name thread start duration ret '
+                                      'args')
+Event = collections.namedtuple('Event', 'time callback_id status_code after')
+
+
+def _target(arg):
+    '''The ctypes object behind a byref()/pointer argument, or arg itself'''
+    obj = getattr(arg, '_obj', None)
+    if obj is not None:
+        return obj
+    if isinstance(arg, ctypes._Pointer):
+        return arg.contents
+    return arg
+
+
+def _snapshot(arg):
+    '''Recordable value of an argument after the call'''
+    arg = _target(arg)
+    if isinstance(arg, ctypes.Array):
+        return arg.value
+    if isinstance(arg, ctypes._SimpleCData):
+        return arg.value
+    if isinstance(arg, (bool, int, float, bytes)) or arg is None:
+        return arg
+    if isinstance(arg, str):
+        return arg.encode('latin-1')
+    # e.g. callback functions
+    return None
+
+
+def _restore(arg, value):
+    '''Write a recorded output value back into a ctypes argument'''
+    arg = _target(arg)
+    if value is None:
+        return
+    if isinstance(arg, ctypes.Array):
+        size = ctypes.sizeof(arg)
+        ctypes.memmove(arg, value[:size - 1] + b'\0',
+                       min(len(value) + 1, size))
+    elif isinstance(arg, ctypes._SimpleCData):
+        arg.value = value
+
+
+def _write_value(out, value):
+    if value is None:
+        out.append(b'n')
+    elif isinstance(value, float):
+        out.append(b'f' + _float.pack(value))
+    elif isinstance(value, bytes):
+        out.append(b'b' + _len.pack(len(value)) + value)
+    else:
+        out.append(b'i' + _int.pack(int(value)))
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError
+    return data
+
+
+def _read_value(f):
+    tag = _read_exact(f, 1)
+    if tag == b'n':
+        return None
+    elif tag == b'f':
+        return _float.unpack(_read_exact(f, _float.size))[0]
+    elif tag == b'b':
+        size = _len.unpack(_read_exact(f, _len.size))[0]
+        return _read_exact(f, size)
+    return _int.unpack(_read_exact(f, _int.size))[0]
+
+
+class Recorder(object):
+    '''
+    Writes call traffic to `path`; see MRC3Client(record=...)
+
+    compresslevel: gzip level; the default favours recording overhead
+    '''
+    def __init__(self, path, compresslevel=1):
+        self.path = path
+        self._file = gzip.open(path, 'wb', compresslevel=compresslevel)
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._names = {}
+        self._threads = {}
+        self._t0 = time.perf_counter()
+
+    def _name_id(self, name):
+        # called with the lock held
+        try:
+            return self._names[name]
+        except KeyError:
+            id_ = self._names[name] = len(self._names)
+            data = name.encode('ascii')
+            self._file.write(_NAME + _name_header.pack(id_, len(data)) + data)
+            return id_
+
+    def _thread_id(self):
+        ident = threading.current_thread().ident
+        try:
+            return self._threads[ident]
+        except KeyError:
+            id_ = self._threads[ident] = len(self._threads)
+            return id_
+
+    def wrap(self, name, function):
+        '''Record every call made through `function`'''
+        if function is None or name in NOT_RECORDED:
+            return function
+
+        def record(*args):
+            start = time.perf_counter()
+            ret = function(*args)
+            end = time.perf_counter()
+            out = []
+            _write_value(out, ret)
+            for arg in args:
+                _write_value(out, _snapshot(arg))
+            with self._lock:
+                if self._file is None:
+                    return ret
+                header = _call_header.pack(self._name_id(name),
+                                           self._thread_id(),
+                                           start - self._t0, end - start,
+                                           len(args))
+                self._file.write(_CALL + header + b''.join(out))
+            return ret
+
+        return record
+
+    def event(self, callback_id, status_code):
+        '''Record a status callback'''
+        t = time.perf_counter() - self._t0
+        with self._lock:
+            if self._file is not None:
+                self._file.write(_EVENT + _event_record.pack(t, callback_id,
+                                                             status_code))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read(path):
+    '''
+    Generator of the Call and Event records in a recording
+
+    A recording cut short (e.g. by a crash) ends at its last complete record.
+    '''
+    names = {}
+    last_call = -1
+    seq = 0
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ReplayError('%s is not a call recording' % path)
+        try:
+            while True:
+                kind = f.read(1)
+                if not kind:
+                    break
+                if kind == _NAME:
+                    id_, size = _name_header.unpack(
+                        _read_exact(f, _name_header.size))
+                    names[id_] = _read_exact(f, size).decode('ascii')
+                elif kind == _CALL:
+                    name_id, thread, start, duration, nargs = \
+                        _call_header.unpack(_read_exact(f, _call_header.size))
+                    ret = _read_value(f)
+                    args = tuple(_read_value(f) for i in range(nargs))
+                    last_call = seq
+                    yield Call(seq, names[name_id], thread, start, duration,
+                               ret, args)
+                    seq += 1
+                elif kind == _EVENT:
+                    t, callback_id, status_code = _event_record.unpack(
+                        _read_exact(f, _event_record.size))
+                    yield Event(t, callback_id, status_code, last_call)
+                else:
+                    raise ReplayError('Corrupt recording: record type %r' %
+                                      kind)
+        except (EOFError, IOError, OSError):
+            pass
+
+
+class ReplayMRC3(object):
+    '''
+    Backend playing a recording back in place of the DLL
+
+    speed: replay speed relative to the recording (None: no delays)
+    strict: raise ReplayError when an input argument (e.g. the script text)
+        differs from the recording
+    '''
+    def __init__(self, path, speed=1.0, strict=False):
+        self.speed = speed
+        self.strict = strict
+        self._calls = collections.defaultdict(collections.deque)
+        self._events = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._callback = None
+        self._pending = []
+        self._pending_cond = threading.Condition()
+        self.calls = 0
+
+        for record in read(path):
+            if isinstance(record, Call):
+                self._calls[record.name].append(record)
+            else:
+                self._events[record.after].append(record)
+
+        self._pump = threading.Thread(target=self._pump_events,
+                                      name='ReplayMRC3 events')
+        self._pump.daemon = True
+        self._pump.start()
+
+    def _delay(self, seconds):
+        if self.speed and seconds > 0:
+            return seconds / self.speed
+        return 0.0
+
+    def __getattr__(self, name):
+        if not name.startswith('mrc3_'):
+            raise AttributeError(name)
+
+        def replay(*args):
+            return self._replay(name, args)
+        replay.__name__ = name
+        return replay
+
+    def _replay(self, name, args):
+        with self._lock:
+            try:
+                call = self._calls[name].popleft()
+            except IndexError:
+                raise ReplayError('No more recorded %s calls' % name)
+            self.calls += 1
+
+        if self.strict:
+            for arg, value in zip(args, call.args):
+                arg = _target(arg)
+                if isinstance(arg, (bytes, str)) and \
+                        _snapshot(arg) != value:
+                    raise ReplayError('%s called with %r, recorded %r' %
+                                      (name, arg, value))
+
+        delay = self._delay(call.duration)
+        if delay:
+            time.sleep(delay)
+        for arg, value in zip(args, call.args):
+            _restore(arg, value)
+        self._schedule_events(call)
+        return call.ret
+
+    # callbacks
+    def mrc3_set_status_callback_function(self, handle, function):
+        self._callback = function
+        self._schedule_events(None)
+        return mrc_common.MRC_ERR_NONE
+
+    def _schedule_events(self, call):
+        if call is None:
+            events, end = self._events.pop(-1, ()), 0.0
+        else:
+            events = self._events.pop(call.seq, ())
+            end = call.start + call.duration
+        if not events:
+            return
+        now = time.perf_counter()
+        with self._pending_cond:
+            for event in events:
+                heapq.heappush(self._pending,
+                               (now + self._delay(event.time - end),
+                                event.time, event))
+            self._pending_cond.notify()
+
+    def _pump_events(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+                due, _, event = self._pending[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    self._pending_cond.wait(wait)
+                    continue
+                heapq.heappop(self._pending)
+
+            callback = self._callback
+            if callback is not None:
+                try:
+                    callback(event.callback_id, event.status_code)
+                except Exception as ex:
+                    print('Replayed callback failed: %s' % ex)
+
+    def remaining(self):
+        '''Number of recorded calls not yet replayed, by function'''
+        with self._lock:
+            return dict((name, len(calls))
+                        for name, calls in self._calls.items() if calls)
+
+
+def summarize(path):
+    '''Per-function call counts and recorded time: {name: (count, seconds)}'''
+    counts = collections.defaultdict(lambda: [0, 0.0])
+    events = 0
+    for record in read(path):
+        if isinstance(record, Call):
+            counts[record.name][0] += 1
+            counts[record.name][1] += record.duration
+        else:
+            events += 1
+    return dict((name, tuple(value)) for name, value in counts.items()), \
+        events
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    calls, events = summarize(args.path)
+    print('%-36s %8s %10s' % ('function', 'calls', 'DLL ms'))
+    for name, (count, seconds) in sorted(calls.items()):
+        print('%-36s %8d %10.1f' % (name, count, seconds * 1e3))
+    print('%d callbacks' % events)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""
+Process-per-instrument worker mode
+
+Each instrument's MRC3Client lives in its own worker process, so neither the
+callback extension's global state nor CPU-heavy analysis in one instrument's
+workflow serializes the others on a single GIL.
+
+Commands are sent over a per-worker queue and complete a
+concurrent.futures.Future in the supervisor. NumPy arrays in results larger
+than `shm_threshold` bytes are handed back through a shared memory block
+instead of being pickled through the queue. Workers that die are restarted
+automatically, with exponential backoff; commands in flight on a dead worker
+fail with WorkerCrashedError. A worker that keeps crashing is marked failed
+after `max_restarts` restarts, and commands sent to it fail at once.
+
+    >>> sup = WorkerSupervisor({'zygo1': dict(end_point='5000',
+    ...                                       protocol='ncacn_ip_tcp', ...)})
+    >>> sup.run_script('zygo1', script_text=..., parse='table',
+    ...                fetch=['parsed']).result().parsed
+
+Script results are detached from the worker's client when returned, so pass
+the fields needed in `fetch`.
+"""
+
+from __future__ import print_function
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import weakref
+from concurrent.futures import Future
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from script_result import ScriptResult
+
+
+class WorkerError(Exception): pass
+class WorkerCrashedError(WorkerError): pass
+
+
+class _SharedArray(object):
+    '''Pickled in place of a large array; refers to a shared memory block'''
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _release_shm(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # a view of the array outlived it; the mapping goes with the process
+        pass
+
+
+def _export(value, threshold, exported):
+    '''Replace large arrays in a result by shared memory references'''
+    if isinstance(value, np.ndarray) and value.nbytes >= threshold:
+        shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        np.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+        exported[shm.name] = shm
+        return _SharedArray(shm.name, value.shape, value.dtype.str)
+    elif isinstance(value, ScriptResult):
+        return ScriptResult(parse=value.parse_kind,
+                            **_export(value.fetched(), threshold, exported))
+    elif isinstance(value, dict):
+        return dict((key, _export(item, threshold, exported))
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_export(item, threshold, exported)
+                           for item in value)
+    return value
+
+
+def _import(value):
+    '''Map shared memory references in a result back to arrays (no copy)'''
+    if isinstance(value, _SharedArray):
+        shm = shared_memory.SharedMemory(name=value.name)
+        arr = np.ndarray(value.shape, np.dtype(value.dtype), buffer=shm.buf)
+        # the block stays mapped for as long as the array lives; unlinking
+        # now means it is freed once both sides have closed it
+        shm.unlink()
+        weakref.finalize(arr, _release_shm, shm)
+        return arr
+    elif isinstance(value, ScriptResult):
+        return ScriptResult(parse=value.parse_kind,
+                            **_import(value.fetched()))
+    elif isinstance(value, dict):
+        return dict((key, _import(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_import(item) for item in value)
+    return value
+
+
+def _make_client(config):
+    if callable(config):
+        return config()
+
+    import zygo
+    return zygo.MRC3Client(**config)
+
+
+def _worker_main(config, commands, results, shm_threshold):
+    client = _make_client(config)
+    exported = {}
+    try:
+        while True:
+            cmd = commands.get()
+            if cmd is None:
+                break
+
+            request_id, method, args, kwargs = cmd
+            if method == '_release':
+                # the supervisor has attached the block; drop our handle
+                shm = exported.pop(args[0], None)
+                if shm is not None:
+                    shm.close()
+                continue
+
+            try:
+                if callable(method):
+                    ret = method(client, *args, **kwargs)
+                else:
+                    ret = getattr(client, method)(*args, **kwargs)
+                ret = _export(ret, shm_threshold, exported)
+                results.put((request_id, True, ret))
+            except Exception as ex:
+                tb = traceback.format_exc()
+                try:
+                    results.put((request_id, False, (ex, tb)))
+                except Exception:
+                    results.put((request_id, False,
+                                 (WorkerError(repr(ex)), tb)))
+    finally:
+        for shm in exported.values():
+            shm.close()
+            shm.unlink()
+        client.close()
+
+
+class _Worker(object):
+    def __init__(self, supervisor, name, config):
+        self.supervisor = supervisor
+        self.name = name
+        self.config = config
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.process = None
+        self.restarts = 0
+        # crashes since the worker last ran for max_restart_delay seconds
+        self.crashes = 0
+        self.failed = None
+        self.stopping = False
+        self._new_queues()
+        self._start_process()
+
+    def _new_queues(self):
+        ctx = self.supervisor.context
+        self.commands = ctx.Queue()
+        self.results = ctx.Queue()
+
+    def _start_process(self):
+        ctx = self.supervisor.context
+        self.started = time.time()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(self.config, self.commands,
+                                         self.results,
+                                         self.supervisor.shm_threshold),
+                                   name='mrc-worker-%s' % self.name)
+        self.process.daemon = True
+        self.process.start()
+
+        self.reader = threading.Thread(target=self._read_results,
+                                       args=(self.process, self.results))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def submit(self, request_id, method, args, kwargs):
+        future = Future()
+        with self.lock:
+            if self.failed is not None:
+                future.set_exception(WorkerCrashedError(self.failed))
+                return future
+            self.pending[request_id] = future
+            self.commands.put((request_id, method, args, kwargs))
+        return future
+
+    def _read_results(self, process, results):
+        while True:
+            try:
+                request_id, success, value = results.get(timeout=0.5)
+            except Exception:
+                if not process.is_alive():
+                    break
+                continue
+
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if success:
+                names = list(_shared_names(value))
+                try:
+                    value = _import(value)
+                finally:
+                    for name in names:
+                        self.commands.put((None, '_release', (name, ), {}))
+                if future is not None:
+                    future.set_result(value)
+            elif future is not None:
+                ex, tb = value
+                ex.worker_traceback = tb
+                future.set_exception(ex)
+
+        if not self.stopping:
+            self._crashed(process)
+
+    def _crashed(self, process):
+        supervisor = self.supervisor
+        message = 'Worker %r exited with code %s' % (self.name,
+                                                     process.exitcode)
+        delay = None
+        # one lock hold: a submit() either reaches the dead worker's pending
+        # commands (failed below) or the new queue
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.stopping:
+                pass
+            elif not supervisor.restart:
+                self.failed = message
+            else:
+                if time.time() - self.started >= supervisor.max_restart_delay:
+                    self.crashes = 0
+                self.crashes += 1
+                if supervisor.max_restarts is not None and \
+                        self.crashes > supervisor.max_restarts:
+                    self.failed = '%s; gave up after %d restarts' % (
+                        message, supervisor.max_restarts)
+                else:
+                    # commands submitted from now on wait in the new queue
+                    # for the new process
+                    self._new_queues()
+                    self.restarts += 1
+                    delay = min(supervisor.max_restart_delay,
+                                supervisor.restart_delay *
+                                2 ** (self.crashes - 1))
+
+        for future in pending.values():
+            future.set_exception(WorkerCrashedError(message))
+
+        if delay is not None:
+            timer = threading.Timer(delay, self._restart)
+            timer.daemon = True
+            timer.start()
+
+    def _restart(self):
+        with self.lock:
+            if not self.stopping:
+                self._start_process()
+
+    def stop(self, timeout=5.0):
+        self.stopping = True
+        self.commands.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.reader.join(timeout)
+
+        # e.g. submitted while waiting to restart
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(WorkerError('Worker %r was stopped' %
+                                             self.name))
+
+
+def _shared_names(value):
+    if isinstance(value, _SharedArray):
+        yield value.name
+    elif isinstance(value, ScriptResult):
+        for name in _shared_names(value.fetched()):
+            yield name
+    elif isinstance(value, dict):
+        for item in value.values():
+            for name in _shared_names(item):
+                yield name
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for name in _shared_names(item):
+                yield name
+
+
+class WorkerSupervisor(object):
+    '''
+    Runs one MRC3Client per instrument, each in its own process
+
+    instruments: {name: config}, where config is either a dict of
+        MRC3Client keyword arguments or a picklable callable returning a
+        client (e.g. functools.partial of a module-level function)
+    shm_threshold: arrays of at least this many bytes are returned through
+        shared memory
+    restart: restart workers that exit unexpectedly
+    restart_delay: delay before the first restart after a crash, doubled
+        for each further crash, up to max_restart_delay seconds; a worker
+        that ran for max_restart_delay seconds starts over
+    max_restarts: consecutive restarts before a worker is marked failed
+        (None: no limit)
+    '''
+    def __init__(self, instruments, shm_threshold=64 * 1024, restart=True,
+                 start_method=None, restart_delay=0.5, max_restart_delay=30.0,
+                 max_restarts=5):
+        self.context = multiprocessing.get_context(start_method)
+        if os.name == 'posix':
+            # workers must share our resource tracker, or each would report
+            # the blocks we unlink as leaked when it exits
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+        self.shm_threshold = shm_threshold
+        self.restart = restart
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts
+        self._ids = itertools.count()
+        self.workers = dict((name, _Worker(self, name, config))
+                            for name, config in instruments.items())
+
+    def submit(self, name, method, *args, **kwargs):
+        '''
+        Call a client method (by name) in the instrument's worker
+
+        `method` may also be a picklable callable, called in the worker as
+        method(client, *args, **kwargs); use this to run analysis next to
+        the client instead of shipping raw data back.
+        '''
+        return self.workers[name].submit(next(self._ids), method, args,
+                                         kwargs)
+
+    def run_script(self, name, **kwargs):
+        return self.submit(name, 'run_script', **kwargs)
+
+    def map(self, method, *args, **kwargs):
+        '''Submit the same call to every instrument: {name: future}'''
+        return dict((name, self.submit(name, method, *args, **kwargs))
+                    for name in self.workers)
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
@@ -0,0 +1,274 @@
+"""
+Append-only measurement result store
+
+Each field is kept in its own fixed-width column file, memory-mapped for
+reading. Rows become visible (and durable) only once a batch is flushed:
+the column files are fsync'd first and then the committed row count is
+atomically replaced, so a crash mid-append loses at most the unflushed batch
+and never leaves a torn row behind.
+
+Two sorted indices (timestamp and part id) are kept alongside the columns,
+so range queries are a pair of binary searches rather than a file scan.
+
+Layout of a store directory:
+    schema.json         field names and dtypes
+    committed           number of valid rows
+    <field>.col         raw column data
+    timestamp.idx       row numbers sorted by timestamp
+    part_id.idx         row numbers sorted by part id
+"""
+
+from __future__ import print_function
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_FIELDS = [
+    ('timestamp', 'f8'),
+    ('part_id', 'S32'),
+    ('stop_num', 'f8'),
+    ('stop_str', 'S64'),
+    ('output', 'S512'),
+]
+
+INDEXED_FIELDS = ('timestamp', 'part_id')
+
+
+class ResultStoreError(Exception): pass
+
+
+def _fsync_write(path, data):
+    '''Atomically replace path with data'''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ResultStore(object):
+    '''
+    Append-only columnar store of measurement results
+
+    fields: list of (name, dtype) pairs; must include 'timestamp' (float
+        seconds since the epoch) and 'part_id'. Only used when creating a
+        new store; an existing store uses its saved schema.
+    batch_size: rows buffered in memory before they are written and fsync'd
+    '''
+    def __init__(self, path, fields=None, batch_size=256):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self._pending = []
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        schema_fn = os.path.join(path, 'schema.json')
+        if os.path.exists(schema_fn):
+            with open(schema_fn, 'r') as f:
+                fields = [tuple(field) for field in json.load(f)]
+        else:
+            if fields is None:
+                fields = DEFAULT_FIELDS
+            fields = [(name, np.dtype(dtype).str) for name, dtype in fields]
+            _fsync_write(schema_fn, json.dumps(fields).encode('ascii'))
+
+        self.dtype = np.dtype([(str(name), dtype) for name, dtype in fields])
+        for name in INDEXED_FIELDS:
+            if name not in self.dtype.names:
+                raise ResultStoreError('Field %r is required' % name)
+
+        self._count = self._recover()
+        self._load_indices()
+
+    def _column_fn(self, name):
+        return os.path.join(self.path, '%s.col' % name)
+
+    def _index_fn(self, name):
+        return os.path.join(self.path, '%s.idx' % name)
+
+    def _recover(self):
+        '''Read the committed row count, discarding any uncommitted tail'''
+        try:
+            with open(os.path.join(self.path, 'committed'), 'rb') as f:
+                count = int(f.read().strip() or 0)
+        except (IOError, OSError):
+            count = 0
+
+        for name in self.dtype.names:
+            fn = self._column_fn(name)
+            size = count * self.dtype[name].itemsize
+            if not os.path.exists(fn):
+                if count:
+                    raise ResultStoreError('Missing column file: %s' % fn)
+                open(fn, 'wb').close()
+            elif os.path.getsize(fn) < size:
+                raise ResultStoreError('Column file truncated: %s' % fn)
+            elif os.path.getsize(fn) > size:
+                with open(fn, 'r+b') as f:
+                    f.truncate(size)
+        return count
+
+    def __len__(self):
+        return self._count
+
+    def column(self, name):
+        '''Read-only memory map of a committed column'''
+        dtype = self.dtype[name]
+        if not self._count:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._column_fn(name), dtype=dtype, mode='r',
+                         shape=(self._count, ))
+
+    def _load_indices(self):
+        self._order = {}
+        self._sorted_keys = {}
+        for name in INDEXED_FIELDS:
+            fn = self._index_fn(name)
+            order = None
+            if os.path.exists(fn) and os.path.getsize(fn) % 8 == 0:
+                order = np.fromfile(fn, dtype=np.int64)
+            if order is None or len(order) != self._count:
+                order = np.argsort(self.column(name), kind='stable')
+                order = order.astype(np.int64)
+                _fsync_write(fn, order.tobytes())
+            self._order[name] = order
+            self._sorted_keys[name] = np.asarray(self.column(name))[order]
+
+    def append(self, timestamp=None, **fields):
+        '''
+        Append a result; unspecified fields are zero/empty
+
+        The row is durable once flush() returns (called automatically every
+        batch_size rows and on close()).
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        fields['timestamp'] = timestamp
+        unknown = set(fields) - set(self.dtype.names)
+        if unknown:
+            raise ResultStoreError('Unknown fields: %s' %
+                                   ', '.join(sorted(unknown)))
+
+        with self._lock:
+            self._pending.append(fields)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        '''Write, fsync and commit all pending rows'''
+        with self._lock:
+            if not self._pending:
+                return
+
+            rows = np.zeros(len(self._pending), dtype=self.dtype)
+            for name in self.dtype.names:
+                rows[name] = [row.get(name, rows[name][0])
+                              for row in self._pending]
+
+            for name in self.dtype.names:
+                # from the committed end, not the end of the file: a flush
+                # that failed may have left its rows in some columns only
+                with open(self._column_fn(name), 'r+b') as f:
+                    f.seek(self._count * self.dtype[name].itemsize)
+                    f.truncate()
+                    f.write(rows[name].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            start = self._count
+            count = start + len(rows)
+            _fsync_write(os.path.join(self.path, 'committed'),
+                         str(count).encode('ascii'))
+
+            for name in INDEXED_FIELDS:
+                self._merge_index(name, rows[name], start)
+
+            self._count = count
+            del self._pending[:]
+
+    def _merge_index(self, name, keys, start):
+        new_order = np.argsort(keys, kind='stable')
+        new_keys = keys[new_order]
+        new_order = new_order.astype(np.int64) + start
+
+        sorted_keys = self._sorted_keys[name]
+        if not len(sorted_keys) or new_keys[0] >= sorted_keys[-1]:
+            # common case: results arrive in timestamp order, so the index
+            # file only needs appending to
+            order = np.concatenate((self._order[name], new_order))
+            sorted_keys = np.concatenate((sorted_keys, new_keys))
+            with open(self._index_fn(name), 'r+b') as f:
+                f.seek(self._order[name].nbytes)
+                f.truncate()
+                f.write(new_order.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            pos = np.searchsorted(sorted_keys, new_keys, side='right')
+            order = np.insert(self._order[name], pos, new_order)
+            sorted_keys = np.insert(sorted_keys, pos, new_keys)
+            _fsync_write(self._index_fn(name), order.tobytes())
+
+        self._order[name] = order
+        self._sorted_keys[name] = sorted_keys
+
+    def _rows_in_range(self, name, lo, hi, inclusive=False):
+        keys = self._sorted_keys[name]
+        left = 0 if lo is None else np.searchsorted(keys, lo, side='left')
+        side = 'right' if inclusive else 'left'
+        right = len(keys) if hi is None else np.searchsorted(keys, hi,
+                                                             side=side)
+        return self._order[name][left:right]
+
+    def query(self, start=None, end=None, part_id=None, fields=None):
+        '''
+        Committed rows with start <= timestamp < end, optionally restricted
+        to a single part id, in timestamp order
+
+        Returns a structured array containing `fields` (default: all).
+        '''
+        with self._lock:
+            if part_id is not None:
+                if not isinstance(part_id, bytes):
+                    part_id = part_id.encode('latin-1')
+                rows = self._rows_in_range('part_id', part_id, part_id,
+                                           inclusive=True)
+                timestamps = self.column('timestamp')[rows]
+                mask = np.ones(len(rows), dtype=bool)
+                if start is not None:
+                    mask &= timestamps >= start
+                if end is not None:
+                    mask &= timestamps < end
+                rows = rows[mask][np.argsort(timestamps[mask],
+                                             kind='stable')]
+            else:
+                rows = self._rows_in_range('timestamp', start, end)
+
+            if fields is None:
+                fields = self.dtype.names
+            count = len(rows)
+            if count and rows[-1] - rows[0] + 1 == count and \
+                    (np.diff(rows) == 1).all():
+                # rows appended in timestamp order are contiguous on disk
+                rows = slice(rows[0], rows[-1] + 1)
+
+            ret = np.empty(count, dtype=[(name, self.dtype[name])
+                                         for name in fields])
+            for name in fields:
+                ret[name] = self.column(name)[rows]
+            return ret
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
@@ -0,0 +1,246 @@
+"""
+High-rate SCAN_OFFSET capture
+
+MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET events arrive many times per
+vertical scan, too often to handle as Python calls. While a ScanCapture is
+recording, the callback extension writes the time of each event straight
+into a preallocated int64 array (one per scan) without taking the GIL or
+creating any Python object; the event never reaches _main_callback.
+
+Scans are delimited by the BEGIN_ACQUIRE/END_ACQUIRE callbacks, or by
+begin_scan()/end_scan():
+
+    >>> capture = ScanCapture(client)
+    >>> client.run_script(script_text='measure')
+    >>> scan = capture.scans[-1]
+    >>> scan.count, scan.duration, scan.jitter
+
+Timestamps are nanoseconds on the clock of time.perf_counter_ns(), so they
+can be lined up with other data sampled on the same machine.
+
+Without the extension (stand-in backends), events are recorded by a Python
+callback into the same arrays; that path creates Python objects per event
+and is several times slower (`python bench.py scan_capture`).
+
+The extension has a single capture slot per process, so only one ScanCapture
+can use it at a time; it records only events from its client's callback id.
+"""
+
+from __future__ import print_function
+import collections
+import threading
+import time
+
+import numpy as np
+
+import mrc_common
+
+# mrc_common.h documents no MRC_CALLBACK_STATUS_* code for scan offset events
+# (nor for mrcstatus ones); like _main_callback, we take them to be reported
+# with the value of their enable bit
+SCAN_OFFSET_STATUS = mrc_common.MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET
+
+# the ScanCapture using the extension's capture slot
+_slot_owner = None
+_slot_lock = threading.Lock()
+
+
+class Scan(object):
+    '''SCAN_OFFSET timeline of one scan'''
+    def __init__(self, timeline, begin, end, seen):
+        #: event times, ns (perf_counter_ns clock)
+        self.timeline = timeline
+        #: scan start and end, ns
+        self.begin = begin
+        self.end = end
+        #: events that did not fit in the preallocated array
+        self.dropped = max(0, seen - len(timeline))
+
+    @property
+    def count(self):
+        return len(self.timeline)
+
+    @property
+    def duration(self):
+        '''Scan duration, in seconds'''
+        return (self.end - self.begin) * 1e-9
+
+    @property
+    def intervals(self):
+        '''Times between consecutive events, in seconds'''
+        return np.diff(self.timeline) * 1e-9
+
+    @property
+    def mean_interval(self):
+        intervals = self.intervals
+        return float(intervals.mean()) if len(intervals) else float('nan')
+
+    @property
+    def jitter(self):
+        '''Standard deviation of the event intervals, in seconds'''
+        intervals = self.intervals
+        return float(intervals.std()) if len(intervals) else float('nan')
+
+    def summary(self):
+        intervals = self.intervals
+        return {'count': self.count, 'dropped': self.dropped,
+                'duration': self.duration,
+                'mean_interval': self.mean_interval, 'jitter': self.jitter,
+                'max_interval': float(intervals.max()) if len(intervals)
+                else float('nan')}
+
+    def __repr__(self):
+        return 'Scan(count=%d, duration=%.6f, jitter=%.3g)' % (
+            self.count, self.duration, self.jitter)
+
+
+class ScanCapture(object):
+    '''
+    Records SCAN_OFFSET events of `client` into one array per scan
+
+    capacity: events per scan; further events are counted as dropped
+    keep: number of finished scans kept in `scans`
+    auto: begin and end scans on the BEGIN_ACQUIRE/END_ACQUIRE callbacks
+    use_extension: capture in the callback extension (default: when it is
+        built and the client talks to the DLL rather than a backend)
+
+    The extension has a single capture slot per process: creating a second
+    ScanCapture that uses it raises RuntimeError until the first is closed.
+    '''
+    def __init__(self, client, capacity=65536, keep=100, auto=True,
+                 use_extension=None):
+        self.client = client
+        self.capacity = capacity
+        self.scans = collections.deque(maxlen=keep)
+        self.auto = auto
+        self._lock = threading.Lock()
+        self._buffer = None
+        self._next = self._allocate()
+        self._begin = None
+        self._count = 0
+
+        self._ext = None
+        if use_extension is None:
+            use_extension = client._backend is None
+        if use_extension:
+            try:
+                import _mrc3_callbacks
+            except ImportError:
+                pass
+            else:
+                self._claim_slot()
+                self._ext = _mrc3_callbacks
+
+        if self._ext is None:
+            client.add_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET,
+                self._scan_offset)
+        if auto:
+            client.add_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_BEGIN_ACQUIRE,
+                self._acquire_started)
+            client.add_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_ACQUIRE,
+                self._acquire_ended)
+
+    def _claim_slot(self):
+        global _slot_owner
+        with _slot_lock:
+            if _slot_owner is not None:
+                raise RuntimeError('The callback extension is already '
+                                   'capturing for another ScanCapture; '
+                                   'close it first')
+            _slot_owner = self
+
+    def _release_slot(self):
+        global _slot_owner
+        with _slot_lock:
+            if _slot_owner is self:
+                _slot_owner = None
+
+    def _allocate(self):
+        buffer = np.empty(self.capacity, np.int64)
+        # touch every page now rather than on the first events of a scan
+        buffer.fill(0)
+        return buffer
+
+    def _now(self):
+        if self._ext is not None:
+            return self._ext.monotonic_ns()
+        return time.perf_counter_ns()
+
+    def _scan_offset(self, callback_id):
+        # fallback path, without the extension
+        buffer = self._buffer
+        if buffer is not None:
+            if self._count < len(buffer):
+                buffer[self._count] = time.perf_counter_ns()
+            self._count += 1
+
+    def _acquire_started(self, callback_id):
+        self.begin_scan()
+
+    def _acquire_ended(self, callback_id):
+        self.end_scan()
+
+    def begin_scan(self):
+        '''Start recording a new scan (ending any scan in progress)'''
+        with self._lock:
+            self._end_scan()
+            # the array for the next scan is allocated ahead of time, so
+            # starting a scan does not wait on the allocator
+            buffer, self._next = self._next, None
+            if buffer is None:
+                buffer = self._allocate()
+            self._count = 0
+            self._begin = self._now()
+            self._buffer = buffer
+            if self._ext is not None:
+                callback_id = self.client._callback_id
+                self._ext.capture(buffer, SCAN_OFFSET_STATUS,
+                                  -1 if callback_id is None else callback_id)
+        self._next = self._allocate()
+
+    def end_scan(self):
+        '''Finish the scan in progress; returns its Scan (or None)'''
+        with self._lock:
+            return self._end_scan()
+
+    def _end_scan(self):
+        buffer = self._buffer
+        if buffer is None:
+            return None
+        if self._ext is not None:
+            seen = self._ext.capture(None)
+        else:
+            seen = self._count
+        end = self._now()
+        self._buffer = None
+
+        # a copy, so that kept scans don't each hold a full-capacity array
+        scan = Scan(buffer[:min(seen, len(buffer))].copy(), self._begin, end,
+                    seen)
+        self.scans.append(scan)
+        return scan
+
+    @property
+    def recording(self):
+        return self._buffer is not None
+
+    def close(self):
+        '''End any scan in progress and stop listening to the client'''
+        self.end_scan()
+        client = self.client
+        if self._ext is not None:
+            self._release_slot()
+        else:
+            client.remove_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET,
+                self._scan_offset)
+        if self.auto:
+            client.remove_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_BEGIN_ACQUIRE,
+                self._acquire_started)
+            client.remove_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_ACQUIRE,
+                self._acquire_ended)
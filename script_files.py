@@ -0,0 +1,235 @@
+"""
+Promotion of frequently run inline scripts to script files
+
+Script text set with mrc3_set_script_text is sent to MetroPro on every run,
+while a script file is only referenced by its path. ScriptPromoter counts
+inline scripts run by a client; once a long script has been run
+`promote_after` times, it is written once to a file named by the hash of its
+contents in a directory shared with the MetroPro machine, and later runs
+use the filename instead:
+
+    >>> client = MRC3Client(promote_scripts=ScriptPromoter(
+    ...     r'\\\\fileserver\\mrc-scripts', server_dir=r'D:\\mrc-scripts'))
+
+Files are named by content, so changing a script's text simply promotes a
+new file. A promoted file that was modified or removed behind our back is
+rewritten before its next use. Until a run has shown that MetroPro can read
+a promoted file, it is only used by runs that wait for the script, so that
+a file MetroPro cannot find is noticed (from the script error) before the
+caller sees the result, and the script is sent inline instead. Files in use have their modification time
+refreshed hourly; prune() deletes those not used for `max_age` seconds.
+"""
+
+from __future__ import print_function
+import collections
+import hashlib
+import os
+import threading
+import time
+
+PREFIX = 'pyzygo-'
+
+# winerror.h ERROR_FILE_NOT_FOUND, ERROR_PATH_NOT_FOUND: MetroPro could not
+# open the script file. Only these make a promoted file fall back to inline
+# text; any other error may come from the script itself having run.
+NOT_FOUND_ERRORS = frozenset([2, 3])
+
+
+def _write(path, data):
+    '''Atomically create path with data (safe with concurrent writers)'''
+    tmp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# how often a promoted file in use has its modification time refreshed, so
+# that prune() in any client sees it as in use
+TOUCH_INTERVAL = 3600.
+
+
+class _Promoted(object):
+    __slots__ = ('path', 'server_path', 'size', 'mtime', 'confirmed')
+
+    def __init__(self, path, server_path, size, mtime):
+        self.path = path
+        self.server_path = server_path
+        self.size = size
+        self.mtime = mtime
+        # MetroPro has run the file
+        self.confirmed = False
+
+
+class ScriptPromoter(object):
+    '''
+    Decides when inline scripts are run by filename instead
+
+    directory: shared script directory, as seen by this machine
+    server_dir: the same directory as seen by MetroPro (default: directory)
+    promote_after: inline runs before a script is promoted
+    min_length: shorter scripts are always sent inline
+    suffix: file name extension of promoted scripts
+    max_tracked: number of distinct inline scripts counted
+    '''
+    def __init__(self, directory, server_dir=None, promote_after=3,
+                 min_length=256, suffix='.scr', max_tracked=1024):
+        self.directory = directory
+        self.server_dir = server_dir if server_dir is not None else directory
+        self.promote_after = promote_after
+        self.min_length = min_length
+        self.suffix = suffix
+        self.max_tracked = max_tracked
+
+        self._lock = threading.Lock()
+        self._counts = collections.OrderedDict()
+        self._promoted = {}
+        self._rejected = set()
+
+        self.runs_by_file = 0
+        self.bytes_saved = 0
+        self.failures = 0
+
+    @staticmethod
+    def _encode(text):
+        if isinstance(text, bytes):
+            return text
+        return str(text).encode('latin-1')
+
+    def _digest(self, data):
+        return hashlib.sha1(data).hexdigest()
+
+    def filename(self, script_text, unconfirmed=True):
+        '''
+        The server-side filename to run `script_text` by, or None to send it
+        inline; counts the run
+
+        unconfirmed: also return files MetroPro has not run yet; pass False
+            when the caller will not check the script error after the run
+        '''
+        if len(script_text) < self.min_length:
+            return None
+
+        with self._lock:
+            # the text itself is the key: its hash is cached by Python, so
+            # repeated runs of the same string cost no hashing
+            try:
+                entry = self._counts.pop(script_text)
+            except KeyError:
+                entry = [0, None]
+            self._counts[script_text] = entry
+            if len(self._counts) > self.max_tracked:
+                self._counts.popitem(last=False)
+            entry[0] += 1
+        if entry[0] < self.promote_after:
+            return None
+
+        digest = entry[1]
+        if digest is None:
+            digest = entry[1] = self._digest(self._encode(script_text))
+        if digest in self._rejected:
+            return None
+
+        promoted = self._promoted.get(digest)
+        if promoted is None or not self._valid(promoted):
+            promoted = self._promote(digest, self._encode(script_text))
+            if promoted is None:
+                return None
+        if not unconfirmed and not promoted.confirmed:
+            return None
+
+        if time.time() - promoted.mtime > TOUCH_INTERVAL:
+            self._touch(promoted)
+        self.runs_by_file += 1
+        self.bytes_saved += promoted.size - len(promoted.server_path)
+        return promoted.server_path
+
+    def _valid(self, promoted):
+        '''Whether the file is still as we wrote it'''
+        try:
+            st = os.stat(promoted.path)
+        except OSError:
+            return False
+        return st.st_size == promoted.size and st.st_mtime == promoted.mtime
+
+    def _promote(self, digest, data):
+        name = PREFIX + digest + self.suffix
+        path = os.path.join(self.directory, name)
+        try:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            # another client may have promoted the same script already
+            if st is None or st.st_size != len(data) or \
+                    self._file_digest(path) != digest:
+                _write(path, data)
+                st = os.stat(path)
+        except (IOError, OSError):
+            self.failures += 1
+            return None
+
+        server_path = self.server_dir.rstrip('\\/') + \
+            ('\\' if '\\' in self.server_dir else '/') + name
+        promoted = _Promoted(path, server_path.encode('latin-1'), st.st_size,
+                             st.st_mtime)
+        with self._lock:
+            self._promoted[digest] = promoted
+        return promoted
+
+    def _touch(self, promoted):
+        try:
+            os.utime(promoted.path, None)
+            promoted.mtime = os.stat(promoted.path).st_mtime
+        except OSError:
+            pass
+
+    def _file_digest(self, path):
+        with open(path, 'rb') as f:
+            return self._digest(f.read())
+
+    @staticmethod
+    def missing(error):
+        '''Whether script error `error` means MetroPro found no script file'''
+        return error in NOT_FOUND_ERRORS
+
+    def confirm(self, server_path):
+        '''Record that MetroPro has run the file `server_path`'''
+        with self._lock:
+            for promoted in self._promoted.values():
+                if promoted.server_path == server_path:
+                    promoted.confirmed = True
+
+    def reject(self, server_path):
+        '''Send the script promoted as `server_path` inline from now on'''
+        with self._lock:
+            for digest, promoted in list(self._promoted.items()):
+                if promoted.server_path == server_path:
+                    del self._promoted[digest]
+                    self._rejected.add(digest)
+
+    def prune(self, max_age=7 * 24 * 3600.):
+        '''
+        Delete promoted files (of any client) unused for max_age seconds;
+        returns the paths removed
+        '''
+        now = time.time()
+        removed = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(PREFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+                    removed.append(path)
+            except OSError:
+                pass
+
+        with self._lock:
+            for digest, promoted in list(self._promoted.items()):
+                if promoted.path in removed:
+                    del self._promoted[digest]
+        return removed
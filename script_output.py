@@ -0,0 +1,212 @@
+"""
+Typed parsing of MetroPro script output
+
+Delimiter convention:
+    * records are separated by newlines (\\n or \\r\\n)
+    * fields are separated by any run of spaces, tabs, commas or semicolons
+    * key/value records use the first '=' or ':' on the line, e.g.
+      ``print "pv =", pv`` or ``print "rms:", rms``
+
+A number is only taken from a whole field: labels such as ``z2`` or
+``3e:`` are not numbers. Garbled or partial lines are dropped rather than
+raising.
+
+Purely numeric text is converted by np.fromstring in one call, without a
+Python object per token. Float conversion itself dominates, so this is only
+about 1.3x as fast as a split()/float() loop for floats, and 2x for tables,
+where line structure is found on the byte array (``python bench.py parse``).
+Only lines with labels or garbage go through the slower regex path.
+"""
+
+from __future__ import print_function
+import itertools
+import re
+import warnings
+
+import numpy as np
+
+_NUMBER = (br'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+           br'|[-+]?(?:[nN][aA][nN]|[iI][nN][fF])')
+_SEP = br'[ \t,;]+'
+
+number_re = re.compile(_NUMBER)
+# a number making up a whole field, bounded by separators (or '=', ':')
+field_number_re = re.compile(br'(?<![^ \t,;=:\r\n])(?:%s)(?![^ \t,;=:\r\n])'
+                             % _NUMBER)
+numeric_line_re = re.compile(br'^[ \t,;]*(?:%s)(?:%s(?:%s))*[ \t,;]*\r?$' %
+                             (_NUMBER, _SEP, _NUMBER), re.MULTILINE)
+kv_line_re = re.compile(br'^[ \t]*([^=:\r\n]*?)[ \t]*[=:][ \t]*(.*?)[ \t\r]*$',
+                        re.MULTILINE)
+
+# all field separators are mapped to spaces so that bytes.split() can be used
+_sep_table = bytes.maketrans(b',;\t\r', b'    ')
+# characters of numbers and separators; text with any other character is
+# not purely numeric
+_numeric_chars = b'0123456789.+-eEnNaAiIfF \t,;\r\n'
+_non_numeric = np.ones(256, dtype=bool)
+_non_numeric[np.frombuffer(_numeric_chars, dtype=np.uint8)] = False
+
+PARSERS = ('floats', 'table', 'kv')
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('latin-1', 'replace')
+
+
+def _to_float_array(tokens):
+    # a list of bytes tokens, each a single number
+    if not len(tokens):
+        return np.empty(0, dtype=np.float64)
+    return np.array(tokens, dtype=np.float64)
+
+
+def _from_numeric(text):
+    """
+    Numbers separated by whitespace, as a float64 array; ValueError if any
+    field is not a number
+    """
+    if not text.strip():
+        return np.empty(0, dtype=np.float64)
+    with warnings.catch_warnings():
+        # older NumPy warns and stops at the first bad field instead of
+        # raising
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=np.float64, sep=' ')
+        except DeprecationWarning as ex:
+            raise ValueError(str(ex))
+
+
+def _line_index(buf, positions):
+    """Line number of each byte position in buf"""
+    return np.searchsorted(np.flatnonzero(buf == ord('\n')), positions)
+
+
+def _garbled_lines(text):
+    """
+    The lines of `text`, and a bool array flagging those containing
+    characters that cannot appear in a number or separator
+    """
+    lines = text.split(b'\n')
+    buf = np.frombuffer(text, dtype=np.uint8)
+    garbled = np.zeros(len(lines), dtype=bool)
+    garbled[_line_index(buf, np.flatnonzero(_non_numeric[buf]))] = True
+    return lines, garbled
+
+
+def parse_floats(text):
+    """
+    All numbers found in the output, in order, as a 1D float64 array.
+
+    Fields that are not numbers (labels, garbled characters) are skipped.
+    """
+    text = _to_bytes(text)
+    numeric = text
+    if text.translate(None, _numeric_chars):
+        # labels or garbage present: only the lines with them are searched
+        # for numbers
+        lines, garbled = _garbled_lines(text)
+        numeric = b'\n'.join(
+            b' '.join(field_number_re.findall(line)) if is_garbled else line
+            for line, is_garbled in zip(lines, garbled.tolist()))
+    try:
+        return _from_numeric(numeric.translate(_sep_table))
+    except ValueError:
+        # slow path: fields made of number characters that are not numbers
+        return _from_numeric(b' '.join(field_number_re.findall(text)))
+
+
+def _table_lines(text, columns):
+    """
+    The lines of `text` with `columns` fields (default: the most common
+    field count), separators mapped to spaces
+    """
+    # fields per line are counted on the byte array itself, rather than by
+    # splitting each line in Python
+    text = text.translate(_sep_table)
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newline = buf == ord('\n')
+    blank = newline | (buf == ord(' '))
+    starts = ~blank
+    starts[1:] &= blank[:-1]
+    if not len(buf) or not starts.any():
+        return b'', columns or 0
+    line_starts = np.flatnonzero(newline) + 1
+    line_starts = np.concatenate(([0], line_starts[line_starts < len(buf)]))
+    counts = np.add.reduceat(starts, line_starts, dtype=np.intp)
+    if columns is None:
+        columns = int(np.bincount(counts[counts > 0]).argmax())
+
+    keep = counts == columns
+    if not keep[counts > 0].all():
+        text = b'\n'.join(itertools.compress(text.split(b'\n'),
+                                              keep.tolist()))
+    return text, columns
+
+
+def parse_table(text, columns=None):
+    """
+    Rows of purely numeric lines as a 2D float64 array.
+
+    Lines containing anything other than numbers and separators are dropped,
+    as are lines whose field count differs from `columns`. If `columns` is not
+    given, the most common field count among numeric lines is used, so a
+    truncated last line (e.g. from a full output buffer) is ignored.
+    """
+    text = _to_bytes(text)
+    if text.translate(None, _numeric_chars):
+        # drop lines that are not entirely numeric, first by character class
+        lines, garbled = _garbled_lines(text)
+        text = b'\n'.join(itertools.compress(lines, (~garbled).tolist()))
+    try:
+        lines, ncols = _table_lines(text, columns)
+        values = _from_numeric(lines)
+    except ValueError:
+        # slow path: and then by the full number syntax
+        text = b'\n'.join(m.group(0) for m in numeric_line_re.finditer(text))
+        lines, ncols = _table_lines(text, columns)
+        values = _from_numeric(lines)
+
+    if not ncols:
+        return np.empty((0, 0), dtype=np.float64)
+    return values.reshape(-1, ncols)
+
+
+def parse_kv(text):
+    """
+    Key/value lines as a dict.
+
+    Values that are a single number become floats; anything else is kept as
+    a (decoded) string. Lines without a separator are ignored, and later keys
+    override earlier ones.
+    """
+    pairs = [(key.strip(b'"\'').decode('latin-1'), value)
+             for key, value in kv_line_re.findall(_to_bytes(text)) if key]
+    values = [value for key, value in pairs]
+    try:
+        floats = _to_float_array(values).tolist()
+        return dict(zip((key for key, value in pairs), floats))
+    except ValueError:
+        pass
+
+    # slow path: mixed numeric and string values
+    numeric = [number_re.fullmatch(value) is not None for value in values]
+    floats = iter(_to_float_array([value for value, is_number
+                                   in zip(values, numeric) if is_number
+                                   ]).tolist())
+    return dict((key, next(floats) if is_number
+                 else value.strip(b'"\'').decode('latin-1'))
+                for (key, value), is_number in zip(pairs, numeric))
+
+
+def parse(text, kind):
+    if kind == 'floats':
+        return parse_floats(text)
+    elif kind == 'table':
+        return parse_table(text)
+    elif kind == 'kv':
+        return parse_kv(text)
+    raise ValueError('Unknown parse kind %r (expected one of %s)' %
+                     (kind, ', '.join(PARSERS)))
@@ -0,0 +1,265 @@
+"""
+Pipelined per-client script queue
+
+Submitting scripts one at a time through run_script leaves the server idle
+while the caller fetches results, parses them and builds the next script.
+ScriptQueue keeps the server busy instead:
+
+    * scripts are rendered (templates called) and encoded at submit time, in
+      the submitting thread
+    * a dispatcher thread stages and starts the next script as soon as the
+      previous one ends (END_SCRIPT callback, confirmed by mrc3_wait_idle)
+    * between scripts only the requested result fields are read from the
+      DLL; parsing and completing futures happen on a separate harvest
+      thread, off the critical path
+
+The gap between the end of one script and the start of the next is
+recorded in `gaps`.
+"""
+
+from __future__ import print_function
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import mrc_common
+from script_result import ScriptResult
+
+# inline: the script text, when it is run by a promoted file
+_Item = collections.namedtuple('_Item', 'filename text parse fetch check '
+                                        'priority future inline')
+
+
+class ScriptQueue(object):
+    '''
+    Back-to-back script submission for one MRC3Client
+
+    hold_control: hold a control session while the queue has work, so
+        consecutive scripts skip the IDLE->ACTIVE transition
+    max_gaps: number of recent inter-script gaps kept for statistics
+    end_timeout: seconds to wait for the END_SCRIPT callback before waiting
+        in bounded mrc3_wait_idle calls instead (see completion.AdaptiveWait)
+    settle_timeout: seconds the interface may take to go idle after the
+        callback
+    '''
+    def __init__(self, client, hold_control=True, max_gaps=10000,
+                 end_timeout=5.0, settle_timeout=1.0):
+        self.client = client
+        self.hold_control = hold_control
+        self.end_timeout = end_timeout
+        self.settle_timeout = settle_timeout
+        self.gaps = collections.deque(maxlen=max_gaps)
+
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._ended = threading.Event()
+        self._end_time = None
+        self._stopping = False
+        self._harvester = ThreadPoolExecutor(1)
+
+        self._use_callback = bool(client._callback_mask &
+                                  mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_SCRIPT)
+        if self._use_callback:
+            client.add_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_SCRIPT,
+                self._script_ended)
+
+        self._thread = threading.Thread(target=self._dispatch,
+                                        name='ScriptQueue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, script_filename='', script_text='', parse=None,
+               fetch=('output', ), check=True, priority=None, **params):
+        '''
+        Queue a script, returning a Future of its (detached) ScriptResult
+
+        script_text may be a callable, called with **params to render the
+        script; rendering happens here, not between scripts.
+        fetch: result fields read from the DLL between scripts; 'parsed' is
+            computed afterwards from the output, off the critical path
+        check: fail the future with MRC3ClientScriptError if the script
+            failed, as run_script does
+        '''
+        if callable(script_text):
+            script_text = script_text(**params)
+        inline = None
+        if script_text:
+            script_filename = ''
+            promoter = self.client._promoter
+            if promoter is not None:
+                # the script error is checked after each run, so files
+                # MetroPro has not run yet may be used
+                promoted = promoter.filename(script_text)
+                if promoted:
+                    inline = script_text
+                    if not isinstance(inline, bytes):
+                        inline = str(inline).encode('latin-1')
+                    script_filename, script_text = promoted, ''
+        if not isinstance(script_text, bytes):
+            script_text = str(script_text).encode('latin-1')
+        if not isinstance(script_filename, bytes):
+            script_filename = str(script_filename).encode('latin-1')
+
+        fetch = list(fetch)
+        if 'parsed' in fetch and 'output' not in fetch:
+            fetch.append('output')
+        if check:
+            fetch.append('error')
+
+        future = Future()
+        item = _Item(script_filename, script_text, parse, fetch, check,
+                     priority, future, inline)
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError('Script queue has been closed')
+            self._items.append(item)
+            self._cond.notify()
+        return future
+
+    def _script_ended(self, callback_id):
+        self._end_time = time.perf_counter()
+        self._ended.set()
+
+    def _next_item(self, block):
+        with self._cond:
+            while not self._items and not self._stopping and block:
+                self._cond.wait()
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def _dispatch(self):
+        session = None
+        last_end = None
+        while True:
+            item = self._next_item(block=False)
+            if item is None:
+                if session is not None:
+                    session.exit()
+                    session = None
+                last_end = None
+                item = self._next_item(block=True)
+                if item is None:
+                    return
+
+            if not item.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                if self.hold_control and session is None:
+                    session = self.client.session()
+                    session.enter()
+                values, last_end = self.client._admit(
+                    self._run_item, (item, last_end), priority=item.priority)
+            except Exception as ex:
+                item.future.set_exception(ex)
+                last_end = None
+                continue
+
+            self._harvester.submit(self._harvest, item, values)
+
+    def _run_item(self, item, last_end):
+        client = self.client
+        handle = client._handle
+        client._script_generation += 1
+
+        # one of the two is empty, clearing whatever the last script used
+        client._set_script_filename(handle, item.filename)
+        client._set_script_text(handle, item.text)
+
+        self._ended.clear()
+        start = time.perf_counter()
+        try:
+            client._start_script(handle)
+        except Exception as ex:
+            if item.inline is None or \
+                    not client._promoter.missing(getattr(ex, 'code', None)):
+                raise
+            return self._run_inline(item, last_end)
+        if last_end is not None:
+            self.gaps.append(start - last_end)
+
+        end = None
+        if self._use_callback and self._ended.wait(self.end_timeout):
+            # the interface may lag the callback slightly; this returns at
+            # once if it is already idle
+            try:
+                client._wait_idle(handle,
+                                  max(1, int(self.settle_timeout * 1e3)))
+                end = self._end_time
+            except Exception as ex:
+                # still running: the callback was a late one, from an
+                # earlier script
+                if getattr(ex, 'code', None) != \
+                        mrc_common.MRC_ERR_TIMEOUT_WAITING_FOR_IDLE:
+                    raise
+        if end is None:
+            # no callback, or a long script (or a lost or stray callback):
+            # bounded waits, so a stuck script is noticed
+            client.waiter.wait(item.text or item.filename, start)
+            end = time.perf_counter()
+
+        generation = client._script_generation
+        values = {}
+        if item.inline is not None:
+            values['error'] = client._fetch_script_unit(generation, 'error')
+            if client._promoter.missing(values['error']):
+                return self._run_inline(item, end)
+            client._promoter.confirm(item.filename)
+        for field in item.fetch:
+            if field != 'parsed' and field not in values:
+                values[field] = client._fetch_script_unit(generation, field)
+        return values, end
+
+    def _run_inline(self, item, last_end):
+        '''Run an item whose promoted file MetroPro could not find inline'''
+        self.client._promoter.reject(item.filename)
+        return self._run_item(item._replace(filename=b'', text=item.inline,
+                                            inline=None), last_end)
+
+    def _harvest(self, item, values):
+        try:
+            if item.check and values['error'] != mrc_common.MRC_ERR_NONE:
+                # a local DLL call; the server is not involved
+                values['error_message'] = self.client.get_error_message(
+                    values['error'])
+            result = ScriptResult(parse=item.parse, **values)
+            if item.check:
+                result.check()
+            if 'parsed' in item.fetch:
+                result.fetch('parsed')
+        except Exception as ex:
+            item.future.set_exception(ex)
+        else:
+            item.future.set_result(result)
+
+    def stats(self):
+        '''Inter-script gap statistics, in seconds'''
+        gaps = sorted(self.gaps)
+        if not gaps:
+            return {'count': 0}
+        return {'count': len(gaps),
+                'mean': sum(gaps) / len(gaps),
+                'p50': gaps[len(gaps) // 2],
+                'p99': gaps[min(len(gaps) - 1, int(len(gaps) * 0.99))],
+                'max': gaps[-1]}
+
+    def __len__(self):
+        return len(self._items)
+
+    def close(self, wait=True):
+        with self._cond:
+            self._stopping = True
+            if not wait:
+                for item in self._items:
+                    item.future.cancel()
+                self._items.clear()
+            self._cond.notify()
+        self._thread.join()
+        self._harvester.shutdown(wait=True)
+        if self._use_callback:
+            self.client.remove_callback_function(
+                mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_SCRIPT,
+                self._script_ended)
@@ -0,0 +1,125 @@
+"""
+Result of a script run by MRC3Client.run_script
+
+Every field is fetched from the DLL only when first accessed, and at most
+once, so a caller that only needs the stop value pays for a single call.
+The DLL only keeps the results of the *last* script run on a handle:
+accessing an unfetched field after another script has been started on the
+same client raises MRC3ClientStaleResultError.
+
+Results received from another process (mrc_daemon, mrc_workers) carry only
+the fields fetched before they were sent.
+
+A script run without waiting is finished on a helper thread; if that fails
+(the wait times out, or the check finds a script error), check() raises the
+error.
+"""
+
+FIELDS = ('error', 'error_message', 'output', 'stop_float', 'stop_str',
+          'parsed')
+
+_UNSET = object()
+
+
+class ScriptResult(object):
+    __slots__ = ('_client', '_generation', 'parse_kind', '_failure') + \
+        tuple('_%s' % field for field in FIELDS)
+
+    def __init__(self, client=None, generation=None, parse=None, **values):
+        self._client = client
+        self._generation = generation
+        self.parse_kind = parse
+        self._failure = None
+        for field in FIELDS:
+            setattr(self, '_%s' % field, values.pop(field, _UNSET))
+        if values:
+            raise TypeError('Unknown fields: %s' % ', '.join(sorted(values)))
+
+    def _get(self, field):
+        slot = '_%s' % field
+        value = getattr(self, slot)
+        if value is _UNSET:
+            if field == 'parsed':
+                import script_output
+                value = script_output.parse(self.output,
+                                            self.parse_kind or 'floats')
+            elif self._client is None:
+                raise ValueError('Field %r was not fetched before the result '
+                                 'was detached from its client' % field)
+            elif field == 'error_message':
+                value = self._client.get_error_message(self.error)
+            else:
+                value = self._client._fetch_script_field(self._generation,
+                                                         field)
+            setattr(self, slot, value)
+        return value
+
+    @property
+    def error(self):
+        '''Error code of the script (MRC_ERR_NONE on success)'''
+        return self._get('error')
+
+    @property
+    def error_message(self):
+        return self._get('error_message')
+
+    @property
+    def output(self):
+        '''Text output of the script, as bytes'''
+        return self._get('output')
+
+    @property
+    def stop_float(self):
+        return self._get('stop_float')
+
+    @property
+    def stop_str(self):
+        return self._get('stop_str')
+
+    @property
+    def parsed(self):
+        '''Output parsed by script_output (kind given by run_script(parse=))'''
+        return self._get('parsed')
+
+    def fetch(self, *fields):
+        '''Fetch the given fields now (e.g. before handing off the result)'''
+        for field in fields:
+            self._get(field)
+        return self
+
+    def fetched(self):
+        '''Dictionary of the fields fetched so far'''
+        return dict((field, getattr(self, '_%s' % field)) for field in FIELDS
+                    if getattr(self, '_%s' % field) is not _UNSET)
+
+    def _fail(self, ex):
+        '''Record the error that kept the script run from completing'''
+        self._failure = ex
+
+    def check(self):
+        '''
+        Raise MRC3ClientScriptError if the script failed, or the error that
+        kept a script run without waiting from completing
+        '''
+        if self._failure is not None:
+            raise self._failure
+        import mrc_common
+        err = self.error
+        if err != mrc_common.MRC_ERR_NONE:
+            from zygo import MRC3ClientScriptError
+            raise MRC3ClientScriptError('Error code %x: %s' %
+                                        (err, self.error_message), err)
+        return self
+
+    def __getstate__(self):
+        state = self.fetched()
+        state['parse'] = self.parse_kind
+        return state
+
+    def __setstate__(self, state):
+        ScriptResult.__init__(self, **state)
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % item
+                           for item in sorted(self.fetched().items()))
+        return 'ScriptResult(%s)' % fields
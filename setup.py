@@ -8,13 +8,19 @@ Python to zygo interferometer (mrc3 / MetroPro)
 """
 
 from distutils.core import setup, Extension
-from sys import version_info
+from sys import version_info, platform
 
 import os
 
+# the DLL is looked up at run time; link against it only where it exists
+if platform == 'win32':
+    libraries = ['mrc3_client']
+else:
+    libraries = ['dl']
+
 callback_dll = Extension('_mrc3_callbacks',
                          sources=['callback_fix.c'],
-                         libraries=['mrc3_client'],
+                         libraries=libraries,
                          language='c++',)
 
 setup(name='mrc4',
@@ -25,5 +31,5 @@ setup(name='mrc4',
       py_modules=[],
       )
 
-import os
-os.system(r'copy build\lib.win32-%d.%d\*.pyd .' % (version_info[:2]))
+if platform == 'win32':
+    os.system(r'copy build\lib.win32-%d.%d\*.pyd .' % (version_info[:2]))
@@ -4,24 +4,234 @@ zygo mrc3 python interface
 
 from __future__ import print_function
 import ctypes
+import threading
 import time
 import os
 
 import mrc_common
 import mrc3_client
-import _mrc3_callbacks
+import admission
+from script_result import ScriptResult
+
+# Imported on first use, to keep `import zygo` fast and platform-neutral:
+#   _mrc3_callbacks: Windows-only extension, when enabling DLL callbacks
+#   script_output: NumPy, when parsing output
+
+def _to_bytes(value):
+    '''Encode str arguments for c_char_p parameters, which take bytes'''
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('latin-1')
+
+class MRC3ClientError(Exception):
+    def __init__(self, message='', code=None):
+        Exception.__init__(self, message)
+        self.code = code
 
-class MRC3ClientError(Exception): pass
 class MRC3ClientNotInitializedError(MRC3ClientError): pass
 class MRC3ClientScriptError(MRC3ClientError): pass
+class MRC3ClientStaleResultError(MRC3ClientError): pass
+
+# The DLL reports events with MRC_CALLBACK_STATUS_* codes, while callbacks are
+# enabled and registered by their MRC_ENABLE_STATUS_CALLBACK_* bitmask. Codes
+# not listed here (mrcstatus, scan offset) are not documented and are looked
+# up as they are.
+_STATUS_MASKS = {
+    mrc_common.MRC_CALLBACK_STATUS_BEGIN_ACQUIRE:
+        mrc_common.MRC_ENABLE_STATUS_CALLBACK_BEGIN_ACQUIRE,
+    mrc_common.MRC_CALLBACK_STATUS_END_ACQUIRE:
+        mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_ACQUIRE,
+    mrc_common.MRC_CALLBACK_STATUS_BEGIN_FDA:
+        mrc_common.MRC_ENABLE_STATUS_CALLBACK_BEGIN_FDA,
+    mrc_common.MRC_CALLBACK_STATUS_END_FDA:
+        mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_FDA,
+    mrc_common.MRC_CALLBACK_STATUS_END_SCRIPT:
+        mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_SCRIPT,
+}
+
+class ControlSession(object):
+    '''
+    Reference-counted hold on ACTIVE control of the server
+
+    The first enter() requests control; control is released once the last
+    holder exits and no one re-enters within idle_timeout seconds. Any
+    thread may enter, and entries nest.
+
+    The operator can drop the server back to IDLE (Esc) while control is
+    held. Commands usually still succeed in IDLE, so this is only noticed by
+    checking the server state: when a session is entered while control is
+    kept between sessions, and by guard() when a command fails with
+    MRC_ERR_COMMAND_TIMEOUT (which cannot happen in the ACTIVE state) or
+    MRC_ERR_RUN_SCRIPT_FAILED. guard() then re-requests control; it retries
+    a timed-out command once, but not a failed script, which may have run.
+    '''
+    def __init__(self, client, idle_timeout=30.0):
+        self.client = client
+        self.idle_timeout = idle_timeout
+        self.active = False
+        self.refcount = 0
+        self._lock = threading.RLock()
+        # guards `active` only; never held while waiting for admission, so
+        # that guard() (already admitted) can take it
+        self._active_lock = threading.Lock()
+        self._timer = None
+
+    def _set_active(self, active):
+        with self._active_lock:
+            self.active = active
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def enter(self):
+        with self._lock:
+            self._cancel_timer()
+            if self.active and not self.refcount and \
+                    self.client.state != mrc_common.MRC_SERVER_STATE_ACTIVE:
+                # kept since the last session, but dropped by the operator
+                self._set_active(False)
+            if not self.active:
+                self.client.request_control()
+                self._set_active(True)
+            self.refcount += 1
+
+    def exit(self, idle_timeout=None):
+        '''
+        Leave the session; idle_timeout overrides self.idle_timeout for
+        this exit
+        '''
+        with self._lock:
+            if self.refcount <= 0:
+                raise RuntimeError('ControlSession.exit() without enter()')
+            self.refcount -= 1
+            if self.refcount > 0 or not self.active:
+                return
+
+            if idle_timeout is None:
+                idle_timeout = self.idle_timeout
+            if not idle_timeout:
+                self._release()
+            else:
+                self._timer = threading.Timer(idle_timeout,
+                                              self._idle_release)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _idle_release(self):
+        with self._lock:
+            if self.refcount == 0 and self.active:
+                self._timer = None
+                self._release()
+
+    def _release(self):
+        self._set_active(False)
+        self.client.release_control()
+
+    def __enter__(self):
+        self.enter()
+        return self.client
+
+    def __exit__(self, type_, value, traceback):
+        self.exit()
+
+    def reset(self):
+        '''Forget any held control without releasing it (e.g., on close)'''
+        with self._lock:
+            self._cancel_timer()
+            self._set_active(False)
+
+    def guard(self, fcn, args):
+        '''
+        Run an admitted command; if control was lost from under a session,
+        re-request it (retrying the command once if it did not run)
+        '''
+        try:
+            return fcn(*args)
+        except MRC3ClientError as ex:
+            if ex.code not in (mrc_common.MRC_ERR_COMMAND_TIMEOUT,
+                               mrc_common.MRC_ERR_RUN_SCRIPT_FAILED) or \
+                    not self.refcount:
+                raise
+            # already admitted: call the DLL directly rather than through
+            # the client's accessors, and without self._lock, which may be
+            # held by a thread waiting for admission
+            client = self.client
+            if ex.code == mrc_common.MRC_ERR_RUN_SCRIPT_FAILED:
+                state = ctypes.c_int()
+                client._get_server_state(client._handle, ctypes.byref(state))
+                if state.value == mrc_common.MRC_SERVER_STATE_ACTIVE:
+                    raise
+            with self._active_lock:
+                self.active = False
+                client._request_control(client._handle)
+                self.active = True
+            if ex.code == mrc_common.MRC_ERR_RUN_SCRIPT_FAILED:
+                raise
+        return fcn(*args)
+
+
+class _TimedSession(object):
+    '''A ControlSession entry with its own idle timeout; see session()'''
+    def __init__(self, control, idle_timeout):
+        self.control = control
+        self.idle_timeout = idle_timeout
+
+    def enter(self):
+        self.control.enter()
+
+    def exit(self):
+        self.control.exit(self.idle_timeout)
+
+    def __enter__(self):
+        self.enter()
+        return self.control.client
+
+    def __exit__(self, type_, value, traceback):
+        self.exit()
+
 class MRC3Client(object):
     BUFSIZE = 512
     def __init__(self, path='.', dllname='mrc3_client.dll',
                  user=None, password=None, end_point='localhost', 
                  host='', protocol='ncalrpc', connect=True,
-                 debug=False, callbacks=True, callback_mask=None):
+                 debug=False, callbacks=True, callback_mask=None,
+                 admission=True, retry_policy=None, priority=0,
+                 backend=None, record=None, promote_scripts=None,
+                 completion=None):
+        '''
+        backend: object providing the mrc3_* functions in place of the DLL
+            (e.g. fake_mrc3.FakeMRC3); path and dllname are then unused
+        admission: serialize commands to the server through the shared
+            per-server admission queue, retrying MRC_ERR_SERVER_BUSY and
+            similar errors instead of raising them
+        retry_policy: admission.RetryPolicy for this client (default: the
+            queue's policy)
+        priority: default admission priority; lower values go first
+        record: filename (or mrc_replay.Recorder) to record all mrc3_* calls
+            and callbacks to, for replay with mrc_replay.ReplayMRC3
+        promote_scripts: script_files.ScriptPromoter (or a directory shared
+            with MetroPro) to run frequently used inline scripts by filename
+        completion: default run_script completion, one of 'block',
+            'poll' or 'wait_idle' (see completion.py); 'wait_idle' suits
+            clients without callbacks
+        '''
         self._handle = None
         self._debug = debug
+        self._use_admission = admission
+        self._admission = None
+        self._retry_policy = retry_policy
+        self.priority = priority
+        self._control = ControlSession(self)
+        self._script_generation = 0
+        self._script_queue = None
+        self._check_completion(completion)
+        self.completion = completion
+        self._waiter = None
+        self._script_started = None
+        self._callback_mask = mrc_common.MRC_ENABLE_STATUS_CALLBACK_NONE
+        self._callback_id = None
         self._callbacks = {
             mrc_common.MRC_ENABLE_STATUS_CALLBACK_BEGIN_ACQUIRE : [self.acquire_started],
             mrc_common.MRC_ENABLE_STATUS_CALLBACK_END_ACQUIRE : [self.acquire_ended],
@@ -32,8 +242,35 @@ class MRC3Client(object):
             mrc_common.MRC_ENABLE_STATUS_CALLBACK_SCAN_OFFSET : [self.scan_offset],
         }
 
-        self._dll = ctypes.CDLL(os.path.join(path, dllname))
-        kernel32 = ctypes.windll.kernel32
+        if record is not None and not hasattr(record, 'wrap'):
+            import mrc_replay
+            record = mrc_replay.Recorder(record)
+        self._recorder = record
+
+        if promote_scripts is not None and \
+                not hasattr(promote_scripts, 'filename'):
+            import script_files
+            promote_scripts = script_files.ScriptPromoter(promote_scripts)
+        self._promoter = promote_scripts
+
+        self._backend = backend
+        if backend is None:
+            self._dll = ctypes.CDLL(os.path.join(path, dllname))
+            # a private WinDLL, so that our argtypes don't affect other users
+            # of ctypes.windll.kernel32; HMODULE and FARPROC are pointers
+            GetProcAddress = ctypes.WinDLL('kernel32').GetProcAddress
+            GetProcAddress.argtypes = (ctypes.c_void_p, ctypes.c_char_p)
+            GetProcAddress.restype = ctypes.c_void_p
+
+            def get_function(name, prototype):
+                addr = GetProcAddress(self._dll._handle, name.encode('ascii'))
+                return prototype(addr)
+        else:
+            self._dll = None
+
+            def get_function(name, prototype):
+                return getattr(backend, name, None)
+
         def wrap_function(name, function):
             def do_function(*args):
                 if self._debug: print('* calling %s%s' % (name, tuple(args)), end=': ')
@@ -42,7 +279,8 @@ class MRC3Client(object):
                 if name != 'get_error_message':
                     if isinstance(ret, int) and ret != mrc_common.MRC_ERR_NONE:
                         msg = self.get_error_message(ret)
-                        raise MRC3ClientError('Error code %x: %s' % (ret, msg))
+                        raise MRC3ClientError('Error code %x: %s' % (ret, msg),
+                                              ret)
                 return ret
 
             return do_function
@@ -53,11 +291,13 @@ class MRC3Client(object):
                 pass
                 #print(name, function)
             if hasattr(function, '__call__'):
-                addr = kernel32.GetProcAddress(self._dll._handle, name)
+                function = get_function(name, function)
+                if self._recorder is not None and name.startswith('mrc3_'):
+                    function = self._recorder.wrap(name, function)
                 if name.startswith('mrc3_'):
                     name = name[5:]
 
-                setattr(self, '_%s' % name, wrap_function(name, function(addr)))
+                setattr(self, '_%s' % name, wrap_function(name, function))
 
         if connect:
             self.open_(user=user, password=password, end_point=end_point,
@@ -67,41 +307,236 @@ class MRC3Client(object):
             self.enable_callbacks(mask=callback_mask)
 
     def run_script(self, script_filename='', script_text='', wait_done=True,
-                   callback=None, poll_completion=False, poll_rate=0.1):
+                   callback=None, poll_completion=False, poll_rate=0.1,
+                   parse=None, priority=None, fetch=(), check=True,
+                   completion=None):
+        '''
+        Run a script, returning a ScriptResult
+
+        Result fields (error, output, stop values) are fetched from the DLL
+        only when accessed, unless listed in `fetch`.
+
+        wait_done: wait for the script to finish; otherwise return at once,
+            calling callback(result) on a helper thread once it has and
+            `fetch` and `check` are done (a failure is raised by
+            result.check()). The server stays admitted meanwhile: commands
+            from any thread wait for the script rather than failing with
+            MRC_ERR_SERVER_BUSY.
+        parse: one of 'floats', 'table' or 'kv'; how `result.parsed` parses
+            the output (see `script_output`)
+        priority: admission priority (default: self.priority)
+        fetch: result fields to fetch before returning
+        check: raise MRC3ClientScriptError if the script failed (one extra
+            call); pass check=False when only, e.g., the stop value is
+            needed and failures are handled by the caller
+        completion: how to wait for the script (default: self.completion):
+            'block' in mrc3_run_script, 'poll' script_running every
+            poll_rate seconds, or 'wait_idle' with timeouts adapted to the
+            script's usual duration; poll_completion=True means 'poll'
+        '''
+        self._check_handle()
+        if parse is not None and parse not in ('floats', 'table', 'kv'):
+            raise ValueError('Unknown parse kind %r' % (parse, ))
+        if completion is None:
+            completion = self.completion
+        if completion is None:
+            completion = 'poll' if poll_completion else 'block'
+        self._check_completion(completion)
+
+        args = (script_filename, script_text, wait_done, completion,
+                poll_rate, parse, fetch, check)
+        if wait_done:
+            return self._admit(self._run_script_unit, args,
+                               priority=priority)
+
+        # the server stays admitted while the script runs, so that other
+        # commands queue behind it rather than retrying busy errors; the
+        # helper thread releases it once the script has finished
+        result, hold = self._admit(self._run_script_unit, args,
+                                   priority=priority, hold=True)
+        self.waiter.wait_async(script_text or script_filename,
+                               self._script_started, hold, callback, result,
+                               fetch, check)
+        return result
+
+    @staticmethod
+    def _check_completion(completion):
+        if completion is not None and \
+                completion not in ('block', 'poll', 'wait_idle'):
+            raise ValueError('Unknown completion %r' % (completion, ))
+
+    @property
+    def waiter(self):
+        '''The client's completion.AdaptiveWait, created on first use'''
+        if self._waiter is None:
+            from completion import AdaptiveWait
+            self._waiter = AdaptiveWait(self)
+        return self._waiter
+
+    def _admit(self, fcn, args=(), priority=None, hold=False):
+        '''
+        Run a server command through the admission queue, if enabled
+
+        hold: keep the server admitted after the command; returns
+            (result, admission.Hold or None)
+        '''
+        if self._control.refcount:
+            fcn, args = self._control.guard, (fcn, args)
+        if self._admission is None:
+            result = fcn(*args)
+            return (result, None) if hold else result
+        if priority is None:
+            priority = self.priority
+        if hold:
+            return self._admission.run_and_hold(fcn, args, priority=priority,
+                                                policy=self._retry_policy)
+        return self._admission.run(fcn, args, priority=priority,
+                                   policy=self._retry_policy)
+
+    def session(self, idle_timeout=None):
+        '''
+        Hold ACTIVE control for the duration of the block
+
+        Sessions nest and may be shared between threads; control is only
+        released after the last one exits and idle_timeout (default:
+        self.session_idle_timeout) seconds pass without a new session.
+        Repeated short scripts therefore skip the IDLE->ACTIVE transition.
+        idle_timeout applies to this session only.
+        '''
         self._check_handle()
+        if idle_timeout is not None:
+            return _TimedSession(self._control, idle_timeout)
+        return self._control
 
-        if script_text:
-            self._set_script_filename(self._handle, '')
-            self._set_script_text(self._handle, str(script_text))
+    @property
+    def session_idle_timeout(self):
+        return self._control.idle_timeout
+
+    @session_idle_timeout.setter
+    def session_idle_timeout(self, value):
+        self._control.idle_timeout = value
+
+    def _run_script_unit(self, script_filename, script_text, wait_done,
+                         completion, poll_rate, parse, fetch, check):
+        # results of any previous script are no longer available
+        self._script_generation += 1
+
+        promoted = None
+        if script_text and self._promoter is not None:
+            # without waiting, a missing file would only show in the script
+            # error, after the caller has the result: use files known to work
+            promoted = self._promoter.filename(script_text,
+                                               unconfirmed=wait_done)
+
+        if promoted:
+            self._set_script_text(self._handle, b'')
+            self._set_script_filename(self._handle, promoted)
+        elif script_text:
+            self._set_script_filename(self._handle, b'')
+            self._set_script_text(self._handle, _to_bytes(script_text))
         elif script_filename:
-            self._set_script_text(self._handle, '')
-            self._set_script_filename(self._handle, str(script_filename))
+            self._set_script_text(self._handle, b'')
+            self._set_script_filename(self._handle,
+                                      _to_bytes(script_filename))
 
-        if wait_done:
-            if poll_completion:
-                self._run_script(self._handle, False)
-                while self.script_running:
-                    time.sleep(poll_rate)
-            else:
-                self._run_script(self._handle, True) # TODO
-                #self._run_script(self._handle, False)
-                #time.sleep(1)
-        elif callback:
-            # TODO
+        # durations are learnt per script as the caller wrote it
+        key = script_text or script_filename
+        values = {}
+        try:
+            self._execute_script(wait_done, completion, poll_rate, key)
+        except MRC3ClientError as ex:
+            if not promoted or ex.code in admission.RETRYABLE_ERRORS:
+                raise
+            error = ex.code
+            if error == mrc_common.MRC_ERR_RUN_SCRIPT_FAILED:
+                # a script that ran and failed, or a file MetroPro could not
+                # find: the script error tells which
+                error = self._fetch_script_unit(self._script_generation,
+                                                'error')
+            if not self._promoter.missing(error):
+                raise
+            missing = True
+        else:
+            missing = False
+            if promoted and wait_done:
+                # check would fetch it anyway
+                values['error'] = self._fetch_script_unit(
+                    self._script_generation, 'error')
+                missing = self._promoter.missing(values['error'])
+                if not missing:
+                    self._promoter.confirm(promoted)
+
+        if missing:
+            # MetroPro could not find the promoted file (e.g. the shared
+            # directory is not visible to it), so the script did not run: go
+            # back to sending the text
+            self._promoter.reject(promoted)
+            return self._run_script_unit(script_filename, script_text,
+                                         wait_done, completion, poll_rate,
+                                         parse, fetch, check)
+
+        result = ScriptResult(self, self._script_generation, parse, **values)
+        if not wait_done:
+            # still running
+            return result
+        if check:
+            result.check()
+        return result.fetch(*fetch)
+
+    def _execute_script(self, wait_done, completion, poll_rate, key):
+        '''Start the script and, if wait_done, wait as `completion` says'''
+        if not wait_done:
+            # waited for by the helper thread (see run_script)
+            self._run_script(self._handle, False)
+            self._script_started = time.perf_counter()
+        elif completion == 'wait_idle':
+            self._run_script(self._handle, False)
+            self.waiter.wait(key, time.perf_counter())
+        elif completion == 'poll':
             self._run_script(self._handle, False)
+            while self.script_running:
+                time.sleep(poll_rate)
+        else:
+            self._run_script(self._handle, True)
 
-        err, err_str = self.script_error
-        if err != mrc_common.MRC_ERR_NONE:
-            raise MRC3ClientScriptError('Error code %x: %s' % (err, err_str))
+    def script_queue(self, **kwargs):
+        '''
+        The client's pipelined ScriptQueue, created on first use
 
-        buf = self._create_buffer()
-        self._get_script_output(self._handle, buf, self.BUFSIZE)
-        return buf.value
+        kwargs are passed to script_queue.ScriptQueue on creation.
+        '''
+        self._check_handle()
+        if self._script_queue is None:
+            from script_queue import ScriptQueue
+            self._script_queue = ScriptQueue(self, **kwargs)
+        return self._script_queue
+
+    def _fetch_script_field(self, generation, field):
+        return self._admit(self._fetch_script_unit, (generation, field))
+
+    def _fetch_script_unit(self, generation, field):
+        if generation != self._script_generation:
+            raise MRC3ClientStaleResultError(
+                'Another script has run since this result was returned')
+
+        if field == 'error':
+            err = ctypes.c_int()
+            self._get_script_error(self._handle, ctypes.byref(err))
+            return err.value
+        elif field == 'output':
+            buf = self._create_buffer()
+            self._get_script_output(self._handle, buf, self.BUFSIZE)
+            return buf.value
+        elif field == 'stop_float':
+            return self.get_script_stop_value(float)
+        elif field == 'stop_str':
+            return self.get_script_stop_value(str)
+        raise ValueError('Unknown result field: %r' % (field, ))
 
     @property
     def interface_guid(self):
         guid = self._create_buffer()
-        self._get_interface_guid(guid, self.BUFSIZE)
+        self._admit(self._get_interface_guid, (guid, self.BUFSIZE))
         return guid.value
 
     @property
@@ -117,10 +552,12 @@ class MRC3Client(object):
 
         if type_ == float:
             val = ctypes.c_double()
-            self._get_script_stop_num_val(self._handle, ctypes.byref(val))
+            self._admit(self._get_script_stop_num_val,
+                        (self._handle, ctypes.byref(val)))
         else:
             val = self._create_buffer()
-            self._get_script_stop_str_val(self._handle, val, self.BUFSIZE)
+            self._admit(self._get_script_stop_str_val,
+                        (self._handle, val, self.BUFSIZE))
 
         return val.value
         
@@ -128,10 +565,10 @@ class MRC3Client(object):
         return ctypes.create_string_buffer(size)
 
     def request_control(self):
-        return self._request_control(self._handle)
+        return self._admit(self._request_control, (self._handle, ))
 
     def release_control(self):
-        return self._release_control(self._handle)
+        return self._admit(self._release_control, (self._handle, ))
 
     def _check_handle(self):
         if self._handle is None:
@@ -142,7 +579,7 @@ class MRC3Client(object):
         self._check_handle()
 
         err = ctypes.c_int()
-        self._get_script_error(self._handle, ctypes.byref(err))
+        self._admit(self._get_script_error, (self._handle, ctypes.byref(err)))
         return err.value, self.get_error_message(err)
 
     def get_error_message(self, errno):
@@ -155,13 +592,14 @@ class MRC3Client(object):
     @property
     def script_running(self):
         running = ctypes.c_int()
-        self._get_script_running(self._handle, ctypes.byref(running))
+        self._admit(self._get_script_running,
+                    (self._handle, ctypes.byref(running)))
         return (running.value == 1)
 
     @property
     def state(self):
         state = ctypes.c_int()
-        self._get_server_state(self._handle, ctypes.byref(state))
+        self._admit(self._get_server_state, (self._handle, ctypes.byref(state)))
         return state.value
 
     def open_(self, user=None, password=None, end_point='localhost', 
@@ -172,17 +610,20 @@ class MRC3Client(object):
         if self._handle == mrc_common.MRC_INVALID_HANDLE:
              raise MRC3ClientError('Invalid handle returned')
 
-        self._set_interface_params(self._handle, protocol, host, end_point)
+        self._set_interface_params(self._handle, _to_bytes(protocol),
+                                   _to_bytes(host), _to_bytes(end_point))
+        if self._use_admission:
+            self._admission = admission.get_queue((protocol, host, end_point))
         return self._ping_server(self._handle)
 
     def log(self, text, filename='test.log', open_close=True):
         # NOTE: no real reason to use this that I can see. Just use Python's
         # file handling. Also, note that _open_log_file does not append.
         if open_close:
-            self._open_log_file(filename)
+            self._open_log_file(_to_bytes(filename))
 
         try:
-            self._log_message(text)
+            self._log_message(_to_bytes(text))
         finally:
             if open_close:
                 self._close_log_file()
@@ -233,11 +674,14 @@ class MRC3Client(object):
         self._callbacks[callback_id] = []
 
     def _main_callback(self, callback_id, status_code):
+        if self._recorder is not None:
+            self._recorder.event(callback_id, status_code)
         if self._debug:
             print('\n\n!! main callback', callback_id, status_code)
 
-        if status_code in self._callbacks:
-            for fcn in self._callbacks[status_code]:
+        mask = _STATUS_MASKS.get(status_code, status_code)
+        if mask in self._callbacks:
+            for fcn in self._callbacks[mask]:
                 try:
                     fcn(callback_id)
                 except Exception as ex:
@@ -272,22 +716,36 @@ class MRC3Client(object):
             id_ = self._handle.value
 
         self._set_status_callback_mask(self._handle, mask)
+        self._callback_mask = mask
 
-        cb_type = mrc3_client.mrc3_callback_type
-        self._cb_fcn = cb_type(self._main_callback)
-
-        #self._set_status_callback_function(self._handle, ctypes.byref(self._cb_fcn))
-        print(self._dll._handle, id_)
-        _mrc3_callbacks.set_callback(self._dll._handle, id_, self._main_callback)
+        if self._backend is not None:
+            # stand-in backends take Python callables directly
+            self._set_status_callback_function(self._handle,
+                                               self._main_callback)
+        else:
+            # the extension's C trampoline; no ctypes callback is built
+            import _mrc3_callbacks
+            _mrc3_callbacks.set_callback(self._dll._handle,
+                                         self._handle.value,
+                                         self._main_callback)
 
         self._set_status_callback_id(self._handle, id_)
+        self._callback_id = id_
 
     def close(self):
         self._check_handle()
 
+        if self._script_queue is not None:
+            self._script_queue.close()
+            self._script_queue = None
+        if self._waiter is not None:
+            self._waiter.close()
+        self._control.reset()
         self.release_control()
         self._free_interface(ctypes.byref(self._handle))
         self._handle = None
+        if self._recorder is not None:
+            self._recorder.close()
 
 def test():
     client = None
@@ -298,7 +756,7 @@ def test():
         for i in range(5):
             print('guid', client.interface_guid)
             ret = client.run_script(script_text='\t print "the square root of 2 is", sqrt(2)')
-            print('%d: script output 0: "%s"' % (i, ret))
+            print('%d: script output 0: "%s"' % (i, ret.output))
         #try:
         #    ret = client.run_script(script_filename='test')
         #    print('script output 1: "%s"' % ret)